@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import argparse
+import imp
+import os
+import random
+import time
+
+
+def load_dependency_graph_module():
+    fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generate-dependency-graph.py')
+    return imp.load_source('generate_dependency_graph', fname)
+
+
+def make_synthetic_inclusions(num_headers, fanout):
+    # Header i includes up to `fanout` headers chosen from those before it,
+    # biased toward its near neighbors, which is roughly what a layered
+    # "bits/" tree looks like.
+    inclusions = {}
+    names = ['h%05d.h' % i for i in xrange(num_headers)]
+    for i, fname in enumerate(names):
+        local_headers = []
+        for j in xrange(min(i, fanout)):
+            h = names[max(0, i - 1 - int(random.expovariate(0.05)))]
+            if h not in local_headers:
+                local_headers.append(h)
+        inclusions[fname] = (local_headers, [], [])
+    return inclusions
+
+
+def naive_reduced_edges(inclusions):
+    # The pre-Reachability algorithm from get_graphviz, kept for comparison.
+    def transitively_includes(h1, h2, visited=None):
+        if visited is None:
+            visited = set()
+        visited.add(h1)
+        if h1 == h2:
+            return True
+        next_headers, _, _ = inclusions[h1]
+        return any(transitively_includes(i, h2, visited) for i in next_headers if i not in visited)
+
+    result = {}
+    for fname, value in inclusions.iteritems():
+        local_headers = value[0]
+        result[fname] = [
+            h for h in local_headers
+            if not any(transitively_includes(i, h) for i in local_headers if i != h)
+        ]
+    return result
+
+
+def engine_reduced_edges(module, inclusions):
+    reachability = module.Reachability(inclusions)
+    return dict((fname, reachability.get_reduced_includes(fname)) for fname in inclusions)
+
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return result, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='250,500,1000,2000,4000,8000', help='Comma-separated numbers of headers to try')
+    parser.add_argument('--fanout', type=int, default=6, help='Number of #includes per synthetic header')
+    parser.add_argument('--naive-limit', type=int, default=1000, help='Skip the naive algorithm above this many headers')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random number generator')
+    options = parser.parse_args()
+
+    module = load_dependency_graph_module()
+    random.seed(options.seed)
+
+    print '%8s %8s %12s %12s' % ('headers', 'edges', 'naive (s)', 'engine (s)')
+    for num_headers in [int(n) for n in options.sizes.split(',')]:
+        inclusions = make_synthetic_inclusions(num_headers, options.fanout)
+        num_edges = sum(len(v[0]) for v in inclusions.itervalues())
+        engine_result, engine_time = timed(engine_reduced_edges, module, inclusions)
+        if num_headers <= options.naive_limit:
+            naive_result, naive_time = timed(naive_reduced_edges, inclusions)
+            assert naive_result == engine_result
+            naive_column = '%12.3f' % naive_time
+        else:
+            naive_column = '%12s' % '-'
+        print '%8d %8d %s %12.3f' % (num_headers, num_edges, naive_column, engine_time)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import argparse
+import imp
+import os
+import re
+import time
+
+
+def load_dependency_graph_module():
+    fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generate-dependency-graph.py')
+    return imp.load_source('generate_dependency_graph', fname)
+
+
+def per_line_scan(fname):
+    # The pre-SCANNER_REGEX scanner from list_all_files_included_by, minus
+    # the header lookup, kept for comparison.
+    includes = []
+    std_identifiers = []
+    with open(fname, 'r') as f:
+        for line in f.readlines():
+            m = re.match(r'\s*#\s*include\s+"([^"]*)"', line)
+            if m is not None:
+                includes.append(('"', m.group(1)))
+            m = re.match(r'\s*#\s*include\s+<([^>]*)>', line)
+            if m is not None:
+                includes.append(('<', m.group(1)))
+            std_identifiers += re.findall(r'std::\w+', line)
+            std_identifiers += re.findall(r'::new', line)
+            std_identifiers += re.findall(r'::operator new', line)
+            std_identifiers += re.findall(r'::operator delete', line)
+            std_identifiers += re.findall(r'\b(ptrdiff_t)\b', line)
+            std_identifiers += re.findall(r'\b(u?intptr_t)\b', line)
+            std_identifiers += re.findall(r'\b(u?int\d+_t)\b', line)
+            std_identifiers += re.findall(r'\b(size_t)\b', line)
+            std_identifiers += re.findall(r'\b(typeid)\b', line)
+    return (includes, sorted(set(std_identifiers)))
+
+
+def single_pass_scan(module, fname):
+    includes, std_identifiers = module.scan_file(fname)
+    return (includes, sorted(set(std_identifiers)))
+
+
+def list_all_files_under(root):
+    result = []
+    for dirname, _, fnames in os.walk(root):
+        result += [os.path.join(dirname, fname) for fname in fnames]
+    return sorted(result)
+
+
+def timed(repeat, f, *args):
+    start = time.time()
+    for i in xrange(repeat):
+        result = f(*args)
+    return result, (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'include'), metavar='DIR', help='Directory of files to scan')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of times to scan the whole directory')
+    options = parser.parse_args()
+
+    module = load_dependency_graph_module()
+    fnames = list_all_files_under(options.root)
+    num_bytes = sum(os.path.getsize(fname) for fname in fnames)
+
+    old_results, old_time = timed(options.repeat, lambda: [per_line_scan(fname) for fname in fnames])
+    new_results, new_time = timed(options.repeat, lambda: [single_pass_scan(module, fname) for fname in fnames])
+    for fname, old, new in zip(fnames, old_results, new_results):
+        if old != new:
+            raise RuntimeError('Scanners disagree on %s: %r versus %r' % (fname, old, new))
+
+    print 'Scanned %d files (%d bytes), %d times each' % (len(fnames), num_bytes, options.repeat)
+    print '%-12s %10.2f ms per pass' % ('per-line', old_time * 1000)
+    print '%-12s %10.2f ms per pass' % ('single-pass', new_time * 1000)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import argparse
+import imp
+import os
+import re
+import shutil
+import tempfile
+import time
+
+
+def load_unity_dump_module():
+    fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'unity-dump.py')
+    return imp.load_source('unity_dump', fname)
+
+
+def make_synthetic_tree(dirname, depth, fanout, lines_per_file):
+    # Header d_i includes headers d+1_0 ... d+1_(fanout-1), so every header at
+    # depth d+1 is #included by every header at depth d, but emitted only once.
+    for d in xrange(depth):
+        for i in xrange(fanout):
+            with open(os.path.join(dirname, 'h%d_%d.h' % (d, i)), 'w') as f:
+                f.write('#pragma once\n')
+                if d + 1 < depth:
+                    for j in xrange(fanout):
+                        f.write('#include "h%d_%d.h"\n' % (d + 1, j))
+                for k in xrange(lines_per_file):
+                    f.write('int h%d_%d_var%d = %d;    \n' % (d, i, k, k))
+    with open(os.path.join(dirname, 'main.cc'), 'w') as f:
+        for i in xrange(fanout):
+            f.write('#include "h0_%d.h"\n' % i)
+        f.write('int main() {}\n')
+    return os.path.join(dirname, 'main.cc')
+
+
+def quadratic_preprocess_file(module, fname, include_paths, already_included):
+    # The pre-parse_file algorithm from unity-dump.py, kept for comparison.
+    if fname in already_included:
+        return ''
+    result = ''
+    already_included.add(fname)
+    local_include_paths = include_paths + [os.path.dirname(fname)]
+    try:
+        with open(fname, 'r') as f:
+            for line in f.readlines():
+                m = re.match(r'\s*#\s*include\s+"(.*)"', line)
+                if m is not None:
+                    hname = module.locate_header_file(m.group(1), local_include_paths)
+                    result += quadratic_preprocess_file(module, hname, local_include_paths, already_included)
+                elif re.match(r'#pragma once', line):
+                    pass
+                else:
+                    result += line.rstrip() + '\n'
+        return result
+    except RuntimeError as e:
+        raise RuntimeError(str(e) + ' in ' + fname)
+
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return result, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depths', default='10,20,40,80', help='Comma-separated include-tree depths to try')
+    parser.add_argument('--fanout', type=int, default=4, help='Number of headers at each depth')
+    parser.add_argument('--lines', type=int, default=200, help='Number of lines in each header')
+    options = parser.parse_args()
+
+    module = load_unity_dump_module()
+
+    print '%6s %10s %12s %12s %12s' % ('depth', 'bytes', 'old (s)', 'new (s)', 'cached (s)')
+    for depth in [int(d) for d in options.depths.split(',')]:
+        dirname = tempfile.mkdtemp()
+        try:
+            main_cc = make_synthetic_tree(dirname, depth, options.fanout, options.lines)
+            module.parsed_files.clear()
+            old_result, old_time = timed(quadratic_preprocess_file, module, main_cc, [], set())
+            new_result, new_time = timed(module.preprocess_file, main_cc, [], set())
+            cached_result, cached_time = timed(module.preprocess_file, main_cc, [], set())
+            assert old_result == new_result == cached_result
+            print '%6d %10d %12.3f %12.3f %12.3f' % (depth, len(new_result), old_time, new_time, cached_time)
+        finally:
+            shutil.rmtree(dirname)
@@ -1,33 +1,75 @@
 #!/usr/bin/env python
 
 import argparse
+import cPickle
+import hashlib
+import json
+import mmap
+import multiprocessing
 import os
 import re
+import signal
+import socket
+import SocketServer
 import subprocess
+import sys
 
 
-def allow_std_identifier_from_header(ident, std_header):
-    allowed = {
-        '<atomic>': ['std::atomic'],
-        '<cstddef>': ['ptrdiff_t', 'size_t', 'std::max_align_t'],
-        '<cstdint>': ['int8_t', 'int16_t', 'int32_t', 'int64_t', 'intptr_t', 'uint8_t', 'uint16_t', 'uint32_t', 'uint64_t', 'uintptr_t'],
-        '<exception>': ['std::current_exception', 'std::exception_ptr', 'std::rethrow_exception'],
-        '<initializer_list>': ['std::initializer_list'],
-        '<new>': ['::new', '::operator new', '::operator delete', 'std::align_val_t', 'std::bad_alloc'],
-        '<typeinfo>': ['std::type_info', 'typeid'],
-        '<utility>': ['std::exchange', 'std::move', 'std::forward', 'std::swap'],
-    }
-    allowed_idents_from_header = allowed.get('<' + std_header + '>', [])
-    return (ident in allowed_idents_from_header)
+DEFAULT_STD_ALLOWLIST = {
+    '<atomic>': ['std::atomic'],
+    '<cstddef>': ['ptrdiff_t', 'size_t', 'std::max_align_t'],
+    '<cstdint>': ['int8_t', 'int16_t', 'int32_t', 'int64_t', 'intptr_t', 'uint8_t', 'uint16_t', 'uint32_t', 'uint64_t', 'uintptr_t'],
+    '<exception>': ['std::current_exception', 'std::exception_ptr', 'std::rethrow_exception'],
+    '<initializer_list>': ['std::initializer_list'],
+    '<new>': ['::new', '::operator new', '::operator delete', 'std::align_val_t', 'std::bad_alloc'],
+    '<typeinfo>': ['std::type_info', 'typeid'],
+    '<utility>': ['std::exchange', 'std::move', 'std::forward', 'std::swap'],
+}
 
+# Files that may include std headers without using anything from them.
+DEFAULT_UNNEEDED_HEADER_EXEMPTIONS = ['linux-futex.h']
 
-def list_all_h_files_under(root):
+
+class StdAllowlist(object):
+    # The allowlist is indexed both ways, once: from each identifier to the
+    # std headers that may provide it, and from each std header to the
+    # identifiers it provides.
+    def __init__(self, allowed, exemptions):
+        self.headers_allowing = {}
+        self.idents_allowed_by = {}
+        for header, idents in allowed.iteritems():
+            header = str(header).strip('<>')
+            for ident in idents:
+                self.headers_allowing.setdefault(str(ident), set()).add(header)
+                self.idents_allowed_by.setdefault(header, set()).add(str(ident))
+        self.exemptions = [str(e) for e in exemptions]
+
+    @classmethod
+    def load(cls, config_fnames):
+        # Each config file is JSON of the form
+        #   {"allow": {"<header>": ["ident", ...]}, "exempt": ["fname", ...]}
+        # and extends the built-in defaults.
+        allowed = dict((h, list(idents)) for h, idents in DEFAULT_STD_ALLOWLIST.iteritems())
+        exemptions = list(DEFAULT_UNNEEDED_HEADER_EXEMPTIONS)
+        for fname in config_fnames:
+            with open(fname, 'r') as f:
+                config = json.load(f)
+            for header, idents in config.get('allow', {}).iteritems():
+                allowed.setdefault(header, []).extend(idents)
+            exemptions += config.get('exempt', [])
+        return cls(allowed, exemptions)
+
+    def is_exempt(self, fname):
+        return any(fname.endswith(e) for e in self.exemptions)
+
+
+def list_all_h_files_under(root, extensions=('.h',)):
     def collector(result, dirname, fnames):
         for fname in fnames:
             fullname = dirname + '/' + fname
             if os.path.isdir(fullname):
-                result += list_all_h_files_under(fullname)
-            elif fullname.endswith('.h'):
+                result += list_all_h_files_under(fullname, extensions)
+            elif fullname.endswith(tuple(extensions)):
                 result.append(fullname)
     result = []
     os.path.walk(root, collector, result)
@@ -42,137 +84,701 @@ def locate_header_file(fname, local_include_paths):
     raise RuntimeError('File not found: %s' % fname)
 
 
-def list_all_files_included_by(fname, options):
+# One pass over the whole file finds both the #include directives and the
+# std identifiers. The identifier alternatives are zero-width lookaheads,
+# so that overlapping tokens (e.g. "size_t" inside "std::size_t") are all
+# reported, just as separate findall() calls over each line would report them.
+SCANNER_REGEX = re.compile(r"""(?m)
+    ^[^\S\n]*\#[^\S\n]*include[^\S\n]+(?=(?:"([^"\n]*)"|<([^>\n]*)>))
+  | (?=(std::\w+))
+  | (?=(::new|::operator[ ]new|::operator[ ]delete))
+  | \b(?=(ptrdiff_t|u?intptr_t|u?int\d+_t|size_t|typeid)\b)
+""", re.VERBOSE)
+
+MMAP_THRESHOLD = 1 << 20
+
+
+def scan_buffer(buf):
+    includes = []
+    std_identifiers = []
+    std_end = 0
+    for m in SCANNER_REGEX.finditer(buf):
+        quoted, angled, std_ident, operator_ident, word_ident = m.groups()
+        if quoted is not None:
+            includes.append(('"', quoted))
+        elif angled is not None:
+            includes.append(('<', angled))
+        elif std_ident is not None:
+            # Matches of std::\w+ must not overlap each other.
+            if m.start() >= std_end:
+                std_identifiers.append(std_ident)
+                std_end = m.start() + len(std_ident)
+        else:
+            std_identifiers.append(operator_ident or word_ident)
+    return (includes, std_identifiers)
+
+
+def scan_file(fname):
+    with open(fname, 'r') as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return scan_buffer(buf)
+            finally:
+                buf.close()
+        return scan_buffer(f.read())
+
+
+def get_file_digest(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def scan_file_or_exception(fname):
+    # Pool workers hand exceptions back as values, so that the parent can
+    # raise them in the same order the serial scan would have.
+    try:
+        return (scan_file(fname), None)
+    except Exception as e:
+        return (None, e)
+
+
+class ScanCache(object):
+    # Remembers scan_file()'s result for each file, keyed by path. A file
+    # whose mtime and size are unchanged is a hit without being read; a file
+    # whose content hash is unchanged is a hit without being re-scanned.
+    VERSION = 1
+
+    def __init__(self, fname, rebuild):
+        self.fname = fname
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = rebuild
+        if not rebuild:
+            try:
+                with open(fname, 'rb') as f:
+                    version, entries = cPickle.load(f)
+                if version == self.VERSION:
+                    self.entries = entries
+            except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+                self.dirty = True
+
+    def get(self, fname):
+        st = os.stat(fname)
+        entry = self.entries.get(fname)
+        if entry is not None and (entry['mtime'], entry['size']) != (st.st_mtime, st.st_size):
+            if entry['sha1'] == get_file_digest(fname):
+                entry['mtime'] = st.st_mtime
+                entry['size'] = st.st_size
+                self.dirty = True
+            else:
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return (entry['includes'], entry['std_identifiers'])
+
+    def put(self, fname, scanned):
+        st = os.stat(fname)
+        includes, std_identifiers = scanned
+        self.entries[fname] = {
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'sha1': get_file_digest(fname),
+            'includes': includes,
+            'std_identifiers': sorted(set(std_identifiers)),
+        }
+        self.dirty = True
+
+    def save(self):
+        if self.fname is None or not self.dirty:
+            return
+        self.entries = dict((k, v) for k, v in self.entries.iteritems() if os.path.exists(k))
+        tmpname = self.fname + '.tmp'
+        with open(tmpname, 'wb') as f:
+            cPickle.dump((self.VERSION, self.entries), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, self.fname)
+        self.dirty = False
+
+
+def scan_files(fnames, options, pool):
+    scanned = [None] * len(fnames)
+    misses = []
+    for i, fname in enumerate(fnames):
+        if options.scan_cache is not None:
+            scanned[i] = options.scan_cache.get(fname)
+        if scanned[i] is None:
+            misses.append(i)
+    if pool is not None and len(misses) >= 2:
+        results = pool.map(scan_file_or_exception, [fnames[i] for i in misses])
+    else:
+        results = [scan_file_or_exception(fnames[i]) for i in misses]
+    errors = [None] * len(fnames)
+    for i, (result, error) in zip(misses, results):
+        scanned[i] = result
+        errors[i] = error
+        if error is None and options.scan_cache is not None:
+            options.scan_cache.put(fnames[i], result)
+    return zip(scanned, errors)
+
+
+def list_all_files_included_by(fname, scanned, options):
     local_headers = []
     std_headers = []
-    std_identifiers = []
     local_include_paths = options.include_dir + [os.path.dirname(fname)]
+    includes, std_identifiers = scanned
     try:
-        with open(fname, 'r') as f:
-            for line in f.readlines():
-                m = re.match(r'\s*#\s*include\s+"([^"]*)"', line)
-                if m is not None:
-                    try:
-                        local_headers.append(locate_header_file(m.group(1), local_include_paths))
-                    except RuntimeError:
-                        if not options.ignore_file_not_found:
-                            raise
-                m = re.match(r'\s*#\s*include\s+<([^>]*)>', line)
-                if m is not None:
-                    if options.treat_std_headers_as_local:
-                        try:
-                            local_headers.append(locate_header_file(m.group(1), local_include_paths))
-                        except RuntimeError:
-                            if not options.ignore_file_not_found:
-                                raise
-                    else:
-                        std_headers.append(m.group(1))
-                std_identifiers += re.findall(r'std::\w+', line)
-                std_identifiers += re.findall(r'::new', line)
-                std_identifiers += re.findall(r'::operator new', line)
-                std_identifiers += re.findall(r'::operator delete', line)
-                std_identifiers += re.findall(r'\b(ptrdiff_t)\b', line)
-                std_identifiers += re.findall(r'\b(u?intptr_t)\b', line)
-                std_identifiers += re.findall(r'\b(u?int\d+_t)\b', line)
-                std_identifiers += re.findall(r'\b(size_t)\b', line)
-                std_identifiers += re.findall(r'\b(typeid)\b', line)
+        for delimiter, hname in includes:
+            if delimiter == '<' and not options.treat_std_headers_as_local:
+                std_headers.append(hname)
+                continue
+            try:
+                local_headers.append(locate_header_file(hname, local_include_paths))
+            except RuntimeError:
+                if not options.ignore_file_not_found:
+                    raise
     except RuntimeError as e:
         raise RuntimeError(str(e) + ' in ' + fname)
     return (local_headers, std_headers, sorted(set(std_identifiers)))
 
 
-def build_graph(roots, options):
-    results = {}
-    while roots:
-        frontier = roots
-        roots = []
-        for fname in frontier:
-            if fname in results:
-                continue
-            results[fname] = list_all_files_included_by(fname, options)
-            roots += results[fname][0]
-    return results
+def build_graph(roots, options, pool=None, on_node=None):
+    # Each breadth-first frontier is scanned as a batch (concurrently, with
+    # -j), then merged in frontier order so the result doesn't depend on -j.
+    # If given, on_node(fname, value) is called as each node is finalized.
+    own_pool = (pool is None and options.jobs > 1)
+    if own_pool:
+        pool = multiprocessing.Pool(options.jobs)
+    try:
+        results = {}
+        while roots:
+            frontier = []
+            seen = set()
+            for fname in roots:
+                if fname not in results and fname not in seen:
+                    frontier.append(fname)
+                    seen.add(fname)
+            roots = []
+            for fname, (scanned, error) in zip(frontier, scan_files(frontier, options, pool)):
+                if error is not None:
+                    raise error
+                results[fname] = list_all_files_included_by(fname, scanned, options)
+                roots += results[fname][0]
+                if on_node is not None:
+                    on_node(fname, results[fname])
+        return results
+    finally:
+        if own_pool:
+            pool.terminate()
 
 
-def is_under_source_control(fname):
-    try:
-        x = subprocess.check_output(['git', 'log', '-l', '1', '--format=oneline', fname])
-        return (x != '')
-    except subprocess.CalledProcessError:
-        return False
+def get_strongly_connected_components(inclusions):
+    # Tarjan's algorithm, written iteratively so that deep include chains
+    # can't blow Python's recursion limit. Components are returned in
+    # reverse topological order: each component comes after every
+    # component that it (transitively) includes.
+    def successors(fname):
+        return inclusions[fname][0] if fname in inclusions else []
 
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for start in sorted(inclusions):
+        if start in index:
+            continue
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(successors(start)))]
+        while work:
+            fname, it = work[-1]
+            for h in it:
+                if h not in index:
+                    index[h] = lowlink[h] = len(index)
+                    stack.append(h)
+                    on_stack.add(h)
+                    work.append((h, iter(successors(h))))
+                    break
+                elif h in on_stack:
+                    lowlink[fname] = min(lowlink[fname], index[h])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[fname])
+                if lowlink[fname] == index[fname]:
+                    component = []
+                    while True:
+                        h = stack.pop()
+                        on_stack.discard(h)
+                        component.append(h)
+                        if h == fname:
+                            break
+                    components.append(sorted(component))
+    return components
 
-def get_graphviz(inclusions, options):
 
-    def get_friendly_name(fname):
-        return '"%s"' % os.path.basename(fname)
+def iter_bits(mask):
+    # Yields the index of each set bit, lowest first, in time proportional
+    # to the number of set bits rather than to the width of the mask.
+    s = bin(mask)[:1:-1]
+    i = s.find('1')
+    while i >= 0:
+        yield i
+        i = s.find('1', i + 1)
 
-    def get_decorators(fname):
-        if not is_under_source_control(fname):
-            return ' [style=dashed]'
-        return ''
 
-    def transitively_includes(h1, h2, visited=None):
-        if visited is None:
-            visited = set()
-        visited.add(h1)
-        if h1 == h2:
-            return True
-        next_headers, _, _ = inclusions[h1]
-        return any(transitively_includes(i, h2, visited) for i in next_headers if i not in visited)
+class Reachability(object):
+    def __init__(self, inclusions):
+        self.inclusions = inclusions
+        self.components = get_strongly_connected_components(inclusions)
+        self.nodes = []
+        self.bit = {}
+        self.component_of = {}
+        for i, component in enumerate(self.components):
+            for fname in component:
+                self.bit[fname] = 1 << len(self.nodes)
+                self.nodes.append(fname)
+                self.component_of[fname] = i
+        # Each header's closure is a bitset over self.nodes. Because the
+        # components arrive in reverse topological order, every closure we
+        # need to union in has already been computed.
+        self.closure = {}
+        for i, component in enumerate(self.components):
+            mask = 0
+            for fname in component:
+                mask |= self.bit[fname]
+                for h in self.successors(fname):
+                    if self.component_of[h] != i:
+                        mask |= self.closure[h]
+            for fname in component:
+                self.closure[fname] = mask
+
+    def successors(self, fname):
+        return self.inclusions[fname][0] if fname in self.inclusions else []
+
+    def reaches(self, h1, h2):
+        return bool(self.closure[h1] & self.bit[h2])
+
+    def get_transitive_closure(self, fname):
+        return [self.nodes[i] for i in iter_bits(self.closure[fname])]
+
+    def get_reduced_includes(self, fname):
+        local_headers = self.successors(fname)
+        return [
+            h for h in local_headers
+            if not any(self.reaches(i, h) for i in local_headers if i != h)
+        ]
+
+    def is_cyclic(self, component):
+        return len(component) >= 2 or component[0] in self.successors(component[0])
+
+    def get_cycles(self):
+        return [c for c in self.components if self.is_cyclic(c)]
+
+    def get_condensed_edges(self):
+        # Edges between distinct components. Since self.components is in
+        # reverse topological order, every edge (i, j) has j < i.
+        edges = set()
+        for i, component in enumerate(self.components):
+            for fname in component:
+                for h in self.successors(fname):
+                    j = self.component_of[h]
+                    if j != i:
+                        edges.add((i, j))
+        return sorted(edges)
+
+
+def get_displayed_includes(fname, inclusions, reachability, options):
+    if options.show_transitive_edges:
+        return inclusions[fname][0]
+    return reachability.get_reduced_includes(fname)
+
+
+def build_reverse_index(inclusions):
+    # Maps each (normalized) header path to the files that #include it.
+    reverse_index = {}
+    for fname, value in inclusions.iteritems():
+        for h in value[0]:
+            reverse_index.setdefault(os.path.normpath(h), []).append(os.path.normpath(fname))
+    return reverse_index
+
+
+def get_affected_files(reverse_index, targets):
+    # Everything that transitively includes any of the targets. Each
+    # affected file is visited once, so this is linear in the size of
+    # the affected subgraph rather than of the whole graph.
+    affected = set()
+    worklist = [os.path.normpath(t) for t in targets]
+    while worklist:
+        h = worklist.pop()
+        for fname in reverse_index.get(h, ()):
+            if fname not in affected:
+                affected.add(fname)
+                worklist.append(fname)
+    return sorted(affected)
+
+
+def get_cycle_report(reachability):
+    result = ''
+    for component in reachability.get_cycles():
+        result += 'cycle of %d: %s\n' % (len(component), ' '.join(component))
+    return result
+
+
+def get_condensed_graph(reachability, fmt):
+    edges = reachability.get_condensed_edges()
+    if fmt == 'json':
+        # Components are listed so that each one comes after every
+        # component it includes; edges are [includer, included] pairs.
+        return json.dumps({
+            'components': [
+                {'id': i, 'files': component, 'cyclic': reachability.is_cyclic(component)}
+                for i, component in enumerate(reachability.components)
+            ],
+            'edges': [list(e) for e in edges],
+        }, indent=2, separators=(',', ': '), sort_keys=True) + '\n'
+
+    def get_friendly_name(i):
+        return '"%s"' % '\\n'.join(os.path.basename(fname) for fname in reachability.components[i])
 
     result = ''
     result += 'strict digraph {\n'
     result += '    size="10,8";\n'
     result += '    rankdir=LR;\n'
     result += '    layout=dot;\n\n'
-    for fname, value in inclusions.iteritems():
-        local_headers, std_headers, std_identifiers = value
-        result += '    %s%s;\n' % (get_friendly_name(fname), get_decorators(fname))
-        for h in local_headers:
-            if not options.show_transitive_edges:
-                if any(transitively_includes(i, h) for i in local_headers if i != h):
-                    continue
-            result += '        %s -> %s;\n' % (get_friendly_name(fname), get_friendly_name(h))
+    for i, component in enumerate(reachability.components):
+        result += '    %s%s;\n' % (get_friendly_name(i), ' [style=bold]' if reachability.is_cyclic(component) else '')
+    for i, j in edges:
+        result += '        %s -> %s;\n' % (get_friendly_name(i), get_friendly_name(j))
     result += '}\n'
     return result
 
 
+def get_cost_report(inclusions, reachability):
+    # For each header, the total size of the deduplicated set of local headers
+    # it pulls in (itself included), and how much of that each direct include
+    # contributes that none of the other direct includes would bring anyway.
+    sizes = [None] * len(reachability.nodes)
+    for i, fname in enumerate(reachability.nodes):
+        with open(fname, 'r') as f:
+            data = f.read()
+        sizes[i] = (len(data), data.count('\n'))
+
+    def get_cost(mask):
+        indices = list(iter_bits(mask))
+        return (sum(sizes[i][0] for i in indices), sum(sizes[i][1] for i in indices), len(indices))
+
+    costs = []
+    for fname in inclusions:
+        local_headers = reachability.successors(fname)
+        masks = [reachability.closure[h] for h in local_headers]
+        prefix = [reachability.bit[fname]]
+        for m in masks:
+            prefix.append(prefix[-1] | m)
+        suffix = [0]
+        for m in reversed(masks):
+            suffix.append(suffix[-1] | m)
+        suffix.reverse()
+        marginal = []
+        for i, h in enumerate(local_headers):
+            others = prefix[i] | suffix[i + 1]
+            marginal.append((get_cost(masks[i] & ~others), h))
+        marginal.sort(key=lambda (cost, h): (-cost[0], h))
+        costs.append((get_cost(reachability.closure[fname]), fname, marginal))
+    costs.sort(key=lambda (cost, fname, marginal): (-cost[0], fname))
+
+    result = ''
+    for (num_bytes, num_lines, num_headers), fname, marginal in costs:
+        result += '%10d bytes %8d lines %6d headers  %s\n' % (num_bytes, num_lines, num_headers, fname)
+        for (num_bytes, num_lines, num_headers), h in marginal:
+            result += '    %+10d bytes %+8d lines %+6d headers  via %s\n' % (num_bytes, num_lines, num_headers, h)
+    return result
+
+
+def list_files_under_source_control():
+    # One "git ls-files" for the whole checkout, instead of one "git log"
+    # per node. Outside of a git checkout, nothing is under source control.
+    try:
+        with open(os.devnull, 'w') as dev_null:
+            toplevel = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], stderr=dev_null).strip()
+            fnames = subprocess.check_output(['git', 'ls-files', '-z'], cwd=toplevel, stderr=dev_null).split('\0')
+    except (OSError, subprocess.CalledProcessError):
+        return set()
+    return set(os.path.realpath(os.path.join(toplevel, f)) for f in fnames if f)
+
+
+def is_under_source_control(fname, tracked_files):
+    return os.path.realpath(fname) in tracked_files
+
+
+def iter_graphviz(inclusions, reachability, options):
+
+    def get_friendly_name(fname):
+        return '"%s"' % os.path.basename(fname)
+
+    tracked_files = list_files_under_source_control()
+
+    def get_decorators(fname):
+        if not is_under_source_control(fname, tracked_files):
+            return ' [style=dashed]'
+        return ''
+
+    yield 'strict digraph {\n'
+    yield '    size="10,8";\n'
+    yield '    rankdir=LR;\n'
+    yield '    layout=dot;\n\n'
+    for fname in inclusions:
+        yield '    %s%s;\n' % (get_friendly_name(fname), get_decorators(fname))
+        for h in get_displayed_includes(fname, inclusions, reachability, options):
+            yield '        %s -> %s;\n' % (get_friendly_name(fname), get_friendly_name(h))
+    yield '}\n'
+
+
+def iter_edgelist(inclusions, reachability, options):
+    for fname in inclusions:
+        for h in get_displayed_includes(fname, inclusions, reachability, options):
+            yield '%s %s\n' % (fname, h)
+
+
+class NodeRecordWriter(object):
+    # Streams one JSON record per node, either as JSON Lines or as the
+    # elements of a single JSON array, without holding the document in memory.
+    def __init__(self, f, fmt):
+        self.f = f
+        self.fmt = fmt
+        self.count = 0
+
+    def write(self, fname, value):
+        local_headers, std_headers, std_identifiers = value
+        record = json.dumps({
+            'file': fname,
+            'local_headers': local_headers,
+            'std_headers': std_headers,
+            'std_identifiers': std_identifiers,
+        }, sort_keys=True)
+        if self.fmt == 'jsonl':
+            self.f.write(record + '\n')
+        else:
+            self.f.write(('[\n' if self.count == 0 else ',\n') + record)
+        self.count += 1
+
+    def close(self):
+        if self.fmt == 'json':
+            self.f.write('[]\n' if self.count == 0 else '\n]\n')
+
+
+def list_roots(options):
+    if os.path.isdir(options.root):
+        return list_all_h_files_under(options.root, options.extension)
+    elif os.path.exists(options.root):
+        return [options.root]
+    else:
+        raise RuntimeError('--root seems to be invalid')
+
+
+def iter_text_listing(inclusions, reachability, options):
+    # Unlike the graph formats, the listing shows every direct include
+    # unless it is asked for the transitive reduction.
+    for fname in inclusions:
+        if options.hide_transitive_edges:
+            includes = get_displayed_includes(fname, inclusions, reachability, options)
+        else:
+            includes = inclusions[fname][0]
+        yield '%s => %s\n' % (fname, ' '.join(includes))
+
+
+def find_std_identifier_violations(inclusions, allowlist):
+    violations = []
+    for fname in sorted(inclusions):
+        local_headers, std_headers, std_identifiers = inclusions[fname]
+        for ident in std_identifiers:
+            if not allowlist.headers_allowing.get(ident, set()).intersection(std_headers):
+                violations.append({'file': fname, 'kind': 'identifier-not-allowed', 'name': ident})
+        if allowlist.is_exempt(fname):
+            continue
+        for h in sorted(set(std_headers)):
+            if not allowlist.idents_allowed_by.get(h, set()).intersection(std_identifiers):
+                violations.append({'file': fname, 'kind': 'header-not-needed', 'name': h})
+    return violations
+
+
+def format_violation(violation):
+    if violation['kind'] == 'identifier-not-allowed':
+        return '%s => %s is not allowed' % (violation['file'], violation['name'])
+    else:
+        return '%s => <%s> is not needed for anything' % (violation['file'], violation['name'])
+
+
+class DependencyGraphServer(SocketServer.UnixStreamServer):
+    # Keeps the include graph in memory between queries. Before answering,
+    # it rebuilds the graph through an in-memory ScanCache, so only files
+    # whose mtime has changed are actually re-read.
+    def __init__(self, socket_path, options):
+        self.options = options
+        if options.scan_cache is None:
+            options.scan_cache = ScanCache(None, rebuild=True)
+        self.pool = multiprocessing.Pool(options.jobs) if options.jobs > 1 else None
+        self.inclusions = None
+        self.reachability = None
+        self.refresh()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, DependencyGraphRequestHandler)
+
+    def refresh(self):
+        inclusions = build_graph(list_roots(self.options), self.options, self.pool)
+        self.options.scan_cache.save()
+        if inclusions != self.inclusions:
+            self.inclusions = inclusions
+            self.reachability = Reachability(inclusions)
+            self.reverse_index = build_reverse_index(inclusions)
+
+    def answer(self, words):
+        self.refresh()
+        if words in (['check'], ['check', 'json']):
+            violations = find_std_identifier_violations(self.inclusions, self.options.allowlist)
+            if words == ['check', 'json']:
+                return json.dumps(violations, indent=2, separators=(',', ': '), sort_keys=True) + '\n'
+            if violations:
+                raise RuntimeError('\n'.join(format_violation(v) for v in violations))
+            return ''
+        elif words == ['dot']:
+            return ''.join(iter_graphviz(self.inclusions, self.reachability, self.options))
+        elif words == ['list']:
+            return ''.join(iter_text_listing(self.inclusions, self.reachability, self.options))
+        elif words == ['cost']:
+            return get_cost_report(self.inclusions, self.reachability)
+        elif words == ['cycles']:
+            return get_cycle_report(self.reachability)
+        elif len(words) == 2 and words[0] == 'condensed' and words[1] in ('dot', 'json'):
+            return get_condensed_graph(self.reachability, words[1])
+        elif len(words) >= 2 and words[0] == 'includers':
+            return ''.join('%s\n' % fname for fname in get_affected_files(self.reverse_index, words[1:]))
+        elif len(words) == 2 and words[0] == 'closure':
+            target = words[1]
+            if target not in self.reachability.bit:
+                raise RuntimeError('Not in the graph: %s' % target)
+            return ''.join(
+                '%s\n' % fname for fname in sorted(self.reachability.get_transitive_closure(target))
+                if fname != target
+            )
+        raise RuntimeError('Unknown query: %s' % ' '.join(words))
+
+
+class DependencyGraphRequestHandler(SocketServer.StreamRequestHandler):
+    # The protocol is one query per connection: the client sends a single
+    # line, and the server replies with "OK" or "ERROR" on a line by itself,
+    # followed by the body of the response.
+    def handle(self):
+        words = self.rfile.readline().split()
+        try:
+            body = self.server.answer(words)
+            self.wfile.write('OK\n' + body)
+        except (RuntimeError, IOError, OSError) as e:
+            self.wfile.write('ERROR\n%s\n' % e)
+
+
+def query_server(socket_path, words):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(socket_path)
+    try:
+        s.sendall(' '.join(words) + '\n')
+        f = s.makefile('r')
+        status = f.readline().strip()
+        body = f.read()
+    finally:
+        s.close()
+    return (status == 'OK', body)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--root', default='.', metavar='FILE', help='Root of the dependency graph')
     parser.add_argument('-I', '--include-dir', action='append', default=['.'], metavar='DIR', help='Path(s) to search for local includes')
-    parser.add_argument('--dot', action='store_true', help='Generate a .dot file for GraphViz')
+    parser.add_argument('--format', choices=['text', 'dot', 'edgelist', 'json', 'jsonl'], default='text', help='Output format for the graph')
+    parser.add_argument('--dot', action='store_const', dest='format', const='dot', help='Generate a .dot file for GraphViz (same as --format=dot)')
+    parser.add_argument('--affected-by', nargs='+', metavar='FILE', help='List every file that transitively includes any of the given files')
+    parser.add_argument('--extension', action='append', default=['.h'], metavar='EXT', help='Also start the graph from files under --root ending in EXT (e.g. .cc)')
+    parser.add_argument('--cycles', action='store_true', help='List the include cycles, and fail if there are any')
+    parser.add_argument('--condensed', choices=['dot', 'json'], help='Print the graph with each include cycle collapsed into one node')
+    parser.add_argument('--cost', action='store_true', help='Report the lines and bytes of local headers pulled in by each header')
     parser.add_argument('--show-transitive-edges', action='store_true', help='Show edges to headers that are transitively included anyway')
+    parser.add_argument('--hide-transitive-edges', action='store_true', help='In the text listing, omit includes of headers that are transitively included anyway')
     parser.add_argument('--treat-std-headers-as-local', action='store_true', help='Recurse into <x.h> as well as "x.h"')
     parser.add_argument('--ignore-file-not-found', action='store_true', help='Ignore failure to open an #included file')
+    parser.add_argument('--allowlist', action='append', default=[], metavar='FILE', help='JSON file of extra std identifiers to allow from each std header')
+    parser.add_argument('--violations-json', metavar='FILE', help='Also write every std-identifier violation to FILE as JSON')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='Scan up to N files at once')
+    parser.add_argument('--cache-file', default='.dependency-graph-cache', metavar='FILE', help='Where to keep the results of scanning each file')
+    parser.add_argument('--no-cache', action='store_true', help='Scan every file without reading or writing the cache')
+    parser.add_argument('--rebuild-cache', action='store_true', help='Discard the existing cache and scan every file')
+    parser.add_argument('--serve', action='store_true', help='Keep the graph in memory and answer queries on --socket')
+    parser.add_argument('--query', metavar='QUERY', help='Ask a --serve process one of: check, check json, dot, list, cost, cycles, condensed dot|json, includers FILE..., closure FILE')
+    parser.add_argument('--socket', default='.dependency-graph.sock', metavar='FILE', help='Unix socket used by --serve and --query')
     options = parser.parse_args()
 
+    if options.query:
+        words = options.query.split()
+        if len(words) >= 2 and words[0] in ('includers', 'closure'):
+            words[1:] = [os.path.abspath(w) for w in words[1:]]
+        ok, body = query_server(options.socket, words)
+        sys.stdout.write(body)
+        sys.exit(0 if ok else 1)
+
     options.root = os.path.abspath(options.root)
     options.include_dir = [os.path.abspath(p) for p in options.include_dir]
+    options.allowlist = StdAllowlist.load(options.allowlist)
+    options.scan_cache = None if options.no_cache else ScanCache(options.cache_file, options.rebuild_cache)
 
-    if os.path.isdir(options.root):
-        roots = list_all_h_files_under(options.root)
-    elif os.path.exists(options.root):
-        roots = [options.root]
-    else:
-        raise RuntimeError('--root seems to be invalid')
+    if options.serve:
+        server = DependencyGraphServer(options.socket, options)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(options.socket)
 
-    inclusions = build_graph(roots, options)
+    # The JSON formats are written node by node while the graph is built.
+    writer = NodeRecordWriter(sys.stdout, options.format) if options.format in ('json', 'jsonl') else None
+    inclusions = build_graph(list_roots(options), options, on_node=(writer.write if writer else None))
+    if options.scan_cache is not None:
+        options.scan_cache.save()
+        print >>sys.stderr, 'Scan cache: %d hits, %d misses' % (options.scan_cache.hits, options.scan_cache.misses)
+    if writer is not None:
+        writer.close()
+        sys.exit(0)
+    reachability = Reachability(inclusions)
 
-    if options.dot:
-        print get_graphviz(inclusions, options)
+    if options.format == 'dot':
+        sys.stdout.writelines(iter_graphviz(inclusions, reachability, options))
+        sys.stdout.write('\n')
+    elif options.format == 'edgelist':
+        sys.stdout.writelines(iter_edgelist(inclusions, reachability, options))
+    elif options.affected_by:
+        reverse_index = build_reverse_index(inclusions)
+        for fname in get_affected_files(reverse_index, [os.path.abspath(t) for t in options.affected_by]):
+            print fname
+    elif options.condensed:
+        sys.stdout.write(get_condensed_graph(reachability, options.condensed))
+    elif options.cycles:
+        report = get_cycle_report(reachability)
+        sys.stdout.write(report)
+        sys.exit(1 if report else 0)
+    elif options.cost:
+        sys.stdout.write(get_cost_report(inclusions, reachability))
     else:
-        for fname, value in inclusions.iteritems():
-            local_headers, std_headers, std_identifiers = value
-            print '%s => %s' % (fname, ' '.join(local_headers))
-
-        for fname, value in inclusions.iteritems():
-            local_headers, std_headers, std_identifiers = value
-            for ident in std_identifiers:
-                if not any(allow_std_identifier_from_header(ident, h) for h in std_headers):
-                    raise RuntimeError('%s => %s is not allowed' % (fname, ident))
-            for h in std_headers:
-                if not any(allow_std_identifier_from_header(ident, h) for ident in std_identifiers):
-                    if not any(fname.endswith(h) for h in ['linux-futex.h']):
-                        raise RuntimeError('%s => <%s> is not needed for anything' % (fname, h))
+        sys.stdout.writelines(iter_text_listing(inclusions, reachability, options))
+        violations = find_std_identifier_violations(inclusions, options.allowlist)
+        if options.violations_json:
+            with open(options.violations_json, 'w') as f:
+                json.dump(violations, f, indent=2, separators=(',', ': '), sort_keys=True)
+        for v in violations:
+            print >>sys.stderr, format_violation(v)
+        if violations:
+            print >>sys.stderr, '%d violations found' % len(violations)
+            sys.exit(1)
@@ -1,10 +1,29 @@
 #!/usr/bin/env python
 
 import argparse
+import cPickle
+import distutils.spawn
+import hashlib
+import json
+import multiprocessing.pool
 import os
 import re
-import requests
+import shutil
+import signal
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+
+try:
+    import requests
+except ImportError:
+    requests = None  # only the remote backends need it
+
+
+INCLUDE_REGEX = re.compile(r'\s*#\s*include\s+"(.*)"')
+PRAGMA_ONCE_REGEX = re.compile(r'#pragma once')
 
 
 def locate_header_file(fname, include_paths):
@@ -15,29 +34,154 @@ def locate_header_file(fname, include_paths):
     raise RuntimeError('File not found: %s' % fname)
 
 
-def preprocess_file(fname, include_paths, already_included):
-    if fname in already_included:
-        return ''
-    result = ''
-    already_included.add(fname)
-    local_include_paths = include_paths + [os.path.dirname(fname)]
-    try:
+# Each file is read and matched against the regexes only once (or again if
+# its mtime or size changes). Its body is kept as a list of segments: runs of
+# ordinary lines, already joined into a single string, separated by the names
+# of the headers it #includes.
+parsed_files = {}
+
+
+def parse_file(fname):
+    st = os.stat(fname)
+    key = (fname, st.st_mtime, st.st_size)
+    if key not in parsed_files:
+        segments = []
+        text = []
         with open(fname, 'r') as f:
             for line in f.readlines():
-                m = re.match(r'\s*#\s*include\s+"(.*)"', line)
+                m = INCLUDE_REGEX.match(line)
                 if m is not None:
-                    hname = locate_header_file(m.group(1), local_include_paths)
-                    result += preprocess_file(hname, local_include_paths, already_included)
-                elif re.match(r'#pragma once', line):
+                    segments.append(''.join(text))
+                    segments.append(m.group(1))
+                    text = []
+                elif PRAGMA_ONCE_REGEX.match(line):
                     pass
                 else:
-                    result += line.rstrip() + '\n'
-        return result
+                    text.append(line.rstrip() + '\n')
+        segments.append(''.join(text))
+        parsed_files[key] = segments
+    return parsed_files[key]
+
+
+def preprocess_file_into(chunks, fname, include_paths, already_included):
+    if fname in already_included:
+        return
+    already_included.add(fname)
+    local_include_paths = include_paths + [os.path.dirname(fname)]
+    try:
+        segments = parse_file(fname)
+        chunks.append(segments[0])
+        for i in xrange(1, len(segments), 2):
+            hname = locate_header_file(segments[i], local_include_paths)
+            preprocess_file_into(chunks, hname, local_include_paths, already_included)
+            chunks.append(segments[i + 1])
     except RuntimeError as e:
         raise RuntimeError(str(e) + ' in ' + fname)
 
 
-def run_on_wandbox(code, compiler, options):
+def preprocess_file(fname, include_paths, already_included):
+    chunks = []
+    preprocess_file_into(chunks, fname, include_paths, already_included)
+    return ''.join(chunks)
+
+
+class ResultCache(object):
+    # An on-disk cache of compile-and-run outcomes, one pickle file per
+    # entry, named by the SHA-1 of everything that went into the outcome.
+    # Hits bump the file's mtime, and the least recently used entries are
+    # evicted once the directory grows past max_bytes.
+    def __init__(self, dirname, max_bytes):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+
+    def get_key(self, backend, compiler, options, code):
+        h = hashlib.sha1()
+        for part in [backend, compiler, repr(options), os.environ.get('CXXFLAGS', ''), code]:
+            h.update(str(part))
+            h.update('\0')
+        return h.hexdigest()
+
+    def get(self, key):
+        fname = os.path.join(self.dirname, key)
+        try:
+            with open(fname, 'rb') as f:
+                result = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        os.utime(fname, None)
+        return result
+
+    def put(self, key, result):
+        # The directory is created only once there is something to put in
+        # it, and each writer uses its own temporary file, since several
+        # processes (e.g. find-bugs.py -j) may share the cache.
+        if not os.path.isdir(self.dirname):
+            try:
+                os.makedirs(self.dirname)
+            except OSError:
+                if not os.path.isdir(self.dirname):
+                    raise
+        fd, tmpname = tempfile.mkstemp(dir=self.dirname, prefix=key + '.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, os.path.join(self.dirname, key))
+        self.evict()
+
+    def list_entries(self):
+        entries = []
+        if not os.path.isdir(self.dirname):
+            return entries
+        for key in os.listdir(self.dirname):
+            try:
+                st = os.stat(os.path.join(self.dirname, key))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, key))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.list_entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.dirname, key))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, key in self.list_entries():
+            try:
+                os.remove(os.path.join(self.dirname, key))
+            except OSError:
+                pass
+
+
+def get_cached_result(cache, backend, compiler, options, code, fetch, is_cacheable=lambda result: True):
+    if cache is None:
+        return fetch()
+    key = cache.get_key(backend, compiler, options, code)
+    result = cache.get(key)
+    if result is None:
+        result = fetch()
+        if is_cacheable(result):
+            cache.put(key, result)
+    return result
+
+
+def run_on_wandbox(code, compiler, options, cache=None):
+    result = get_cached_result(
+        cache, 'wandbox', compiler, options, code,
+        lambda: get_wandbox_result(code, compiler, options),
+        lambda result: 'status' in result,  # don't cache service failures
+    )
+    print_wandbox_result(result)
+    return int(result.get('status', -1))
+
+
+def get_wandbox_result(code, compiler, options):
     data = {
         'code': code,
         'compiler': compiler,
@@ -49,7 +193,10 @@ def run_on_wandbox(code, compiler, options):
         'https://wandbox.org/api/compile.json',
         json=data,
     )
-    result = response.json()
+    return response.json()
+
+
+def print_wandbox_result(result):
     if 'compiler_message' in result:
         print result['compiler_message']
     if 'program_output' in result:
@@ -58,20 +205,10 @@ def run_on_wandbox(code, compiler, options):
         print result['signal']  # e.g. "Aborted"
     if 'program_error' in result:
         print result['program_error']
-    return int(result.get('status', -1))
 
 
-def run_on_rextester(code, language, options):
-    data = {
-        'Program': code,
-        'LanguageChoice': language,
-        'CompilerArgs': options,
-    }
-    response = requests.post(
-        'http://rextester.com/rundotnet/api',
-        data=data,
-    )
-    result = response.json()
+def run_on_rextester(code, language, options, cache=None):
+    result = get_cached_result(cache, 'rextester', language, options, code, lambda: get_rextester_result(code, language, options))
     status = 0
     if result.get('Errors') is not None:
         print result['Errors']  # compiler errors + program stderr
@@ -84,6 +221,190 @@ def run_on_rextester(code, language, options):
     return status
 
 
+def get_rextester_result(code, language, options):
+    data = {
+        'Program': code,
+        'LanguageChoice': language,
+        'CompilerArgs': options,
+    }
+    response = requests.post(
+        'http://rextester.com/rundotnet/api',
+        data=data,
+    )
+    return response.json()
+
+
+local_compiler_identities = {}
+
+
+def get_local_compiler_identity(compiler):
+    # The resolved path of the compiler and what it says about its version,
+    # so that cached results don't outlive an upgrade or a change of PATH.
+    if compiler not in local_compiler_identities:
+        path = distutils.spawn.find_executable(compiler)
+        if path is None:
+            identity = compiler
+        else:
+            path = os.path.realpath(path)
+            try:
+                p = subprocess.Popen([path, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                version = p.communicate()[0]
+            except OSError:
+                version = ''
+            identity = '%s\0%s' % (path, version)
+        local_compiler_identities[compiler] = identity
+    return local_compiler_identities[compiler]
+
+
+def is_cacheable_local_result(result):
+    # A compiler that couldn't be started may well be there next time, and
+    # a program that timed out may have just been starved of CPU.
+    return 'status' in result and result['status'] != 127 and not result.get('timed_out')
+
+
+class ChildProcesses(object):
+    # The compilers and programs started by the concurrent local backends.
+    # Once one backend has failed, kill_all() stops the others, and refuses
+    # to start anything more, so that their threads finish promptly.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = set()
+        self.killed = False
+
+    def communicate(self, args, timeout=None, **kwargs):
+        # Returns (returncode, stdout, stderr, timed_out), or None after
+        # kill_all(). A process still running after `timeout` seconds is
+        # killed, along with its process group.
+        with self.lock:
+            if self.killed:
+                return None
+            # In its own process group, so that kill_all() also gets
+            # whatever the compiler driver has started (e.g. cc1plus).
+            p = subprocess.Popen(args, preexec_fn=os.setpgrp, **kwargs)
+            self.running.add(p)
+        timed_out = []
+        def kill_on_timeout():
+            with self.lock:
+                if p in self.running:
+                    timed_out.append(True)
+                    self.killpg(p)
+        timer = threading.Timer(timeout, kill_on_timeout) if timeout else None
+        try:
+            if timer:
+                timer.start()
+            stdout, stderr = p.communicate()
+        finally:
+            if timer:
+                timer.cancel()
+            with self.lock:
+                self.running.discard(p)
+        return p.returncode, stdout, stderr, bool(timed_out)
+
+    def killpg(self, p):
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass  # it has just exited
+
+    def kill_all(self):
+        with self.lock:
+            self.killed = True
+            for p in self.running:
+                self.killpg(p)
+
+
+def compile_and_run_locally(code, compiler, options, children, timeout=None):
+    # Returns a Wandbox-style result dict, so that the output looks the same
+    # whichever backend produced it, plus the compile and run times.
+    dirname = tempfile.mkdtemp()
+    try:
+        source_file = os.path.join(dirname, 'unity.cc')
+        executable = os.path.join(dirname, 'a.out')
+        with open(source_file, 'w') as f:
+            f.write(code)
+        args = [compiler] + options + os.environ.get('CXXFLAGS', '').split() + [source_file, '-o', executable]
+        start = time.time()
+        try:
+            compiled = children.communicate(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            return {'compiler_message': '%s: %s' % (compiler, e.strerror), 'status': 127}
+        if compiled is None:
+            return {}  # killed; never printed or cached
+        result = {'compile_time': time.time() - start}
+        returncode, compiler_message, _, _ = compiled
+        if compiler_message:
+            result['compiler_message'] = compiler_message
+        if returncode != 0:
+            result['status'] = returncode
+            return result
+        start = time.time()
+        ran = children.communicate([executable], timeout=timeout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if ran is None:
+            return {}
+        result['run_time'] = time.time() - start
+        returncode, program_output, program_error, timed_out = ran
+        if program_output:
+            result['program_output'] = program_output
+        if timed_out:
+            result['signal'] = 'Killed after %s seconds' % timeout
+            result['status'] = 128 - returncode
+            result['timed_out'] = True
+        elif returncode < 0:
+            result['signal'] = 'Signal %d' % -returncode
+            result['status'] = 128 - returncode
+        else:
+            result['status'] = returncode
+        if program_error:
+            result['program_error'] = program_error
+        return result
+    finally:
+        shutil.rmtree(dirname)
+
+
+def run_locally(code, backends, cache=None, timeout=None, timings=None):
+    # backends is a list of (name, compiler, options). All of them compile
+    # and run concurrently, but their results are printed in order, stopping
+    # at the first failure, just as if they had run one after another.
+    # Cache lookups and updates all happen on this thread. If timings is a
+    # dict, each printed backend's compile and run times are added to it.
+    pool = multiprocessing.pool.ThreadPool(max(len(backends), 1))
+    children = ChildProcesses()
+    try:
+        pending = []
+        for _, compiler, options in backends:
+            key = cache.get_key('local', get_local_compiler_identity(compiler), options, code) if cache else None
+            result = cache.get(key) if cache else None
+            if result is None:
+                pending.append((key, pool.apply_async(compile_and_run_locally, (code, compiler, options, children, timeout))))
+            else:
+                pending.append((key, result))
+        for (name, _, _), (key, r) in zip(backends, pending):
+            print 'Running on %s...' % name
+            if isinstance(r, dict):
+                result = r
+            else:
+                result = r.get()
+                if cache and is_cacheable_local_result(result):
+                    cache.put(key, result)
+            if timings is not None:
+                timings[name] = {
+                    'compile': result.get('compile_time'),
+                    'run': result.get('run_time'),
+                    'cached': isinstance(r, dict),
+                }
+            print_wandbox_result(result)
+            if result['status'] != 0:
+                return result['status']
+        return 0
+    finally:
+        # A ThreadPool can't be terminated mid-task, so kill the backends
+        # that are still running and wait for them to clean up after
+        # themselves.
+        children.kill_all()
+        pool.close()
+        pool.join()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('fnames', nargs='*', metavar='FILE', help='File(s) to "preprocess" and dump to stdout')
@@ -92,15 +413,31 @@ if __name__ == '__main__':
     parser.add_argument('--g++', dest='gcc', action='store_true', help='Run on Wandbox using GCC only')
     parser.add_argument('--clang', action='store_true', help='Run on Wandbox using Clang only')
     parser.add_argument('--msvc', action='store_true', help='Run on Rextester using MSVC only')
+    parser.add_argument('--local', action='store_true', help='Run on the local clang++ and g++ (concurrently) instead of Wandbox')
+    parser.add_argument('--timeout', type=float, default=60, metavar='SECONDS', help='Kill a locally compiled program that runs for longer than this')
+    parser.add_argument('--timings', metavar='FILE', help='With --local, write each compiler\'s compile and run times (in seconds) to FILE as JSON')
+    parser.add_argument('--cache-dir', default=os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'unity-dump'), metavar='DIR', help='Where to cache compile-and-run results')
+    parser.add_argument('--cache-size', type=int, default=256, metavar='MB', help='Evict the least recently used results beyond this size')
+    parser.add_argument('--no-cache', action='store_true', help='Always compile and run, without reading or writing the cache')
+    parser.add_argument('--cache-remote', action='store_true', help='Also cache Wandbox and Rextester results (which otherwise are always fetched, since their compilers change upstream)')
+    parser.add_argument('--clear-cache', action='store_true', help='Empty the cache before doing anything else')
     options = parser.parse_args()
 
     options.include_dir = [os.path.abspath(p) for p in options.include_dir]
+    cache = None if options.no_cache else ResultCache(options.cache_dir, options.cache_size << 20)
+    if options.clear_cache:
+        ResultCache(options.cache_dir, 0).clear()
+        if not options.fnames:
+            sys.exit(0)
 
     already_included = set()
-    result = ''
+    chunks = []
     for fname in options.fnames:
-        result += preprocess_file(os.path.abspath(fname), options.include_dir, already_included)
+        preprocess_file_into(chunks, os.path.abspath(fname), options.include_dir, already_included)
+    result = ''.join(chunks)
 
+    if options.local:
+        options.run = True
     if not (options.gcc or options.clang or options.msvc):
         if options.run:
             options.gcc = True
@@ -110,13 +447,31 @@ if __name__ == '__main__':
             print result
 
     status = 0
+    if options.local:
+        if options.msvc:
+            raise RuntimeError('There is no local MSVC backend')
+        backends = []
+        if options.clang:
+            backends += [('Clang', 'clang++', ['-std=c++1z', '-Wall', '-Wextra'])]
+        if options.gcc:
+            backends += [('GCC', 'g++', ['-std=c++1z', '-Wall', '-Wextra'])]
+        timings = {}
+        status = run_locally(result, backends, cache, options.timeout, timings)
+        if options.timings:
+            with open(options.timings, 'w') as f:
+                json.dump(timings, f, sort_keys=True)
+        sys.exit(status)
+    # clang-head, gcc-head and Rextester's MSVC are updated upstream without
+    # changing their names, so a cached result could hide a fix (or a new
+    # bug); cache them only on request.
+    remote_cache = cache if options.cache_remote else None
     if status == 0 and options.clang:
         print 'Running on Clang...'
-        status = run_on_wandbox(result, 'clang-head', 'c++1z,warning')
+        status = run_on_wandbox(result, 'clang-head', 'c++1z,warning', remote_cache)
     if status == 0 and options.gcc:
         print 'Running on GCC...'
-        status = run_on_wandbox(result, 'gcc-head', 'c++1z,warning')
+        status = run_on_wandbox(result, 'gcc-head', 'c++1z,warning', remote_cache)
     if status == 0 and options.msvc:
         print 'Running on MSVC...'
-        status = run_on_rextester(result, 28, 'source_file.cpp -o a.exe')
+        status = run_on_rextester(result, 28, 'source_file.cpp -o a.exe', remote_cache)
     sys.exit(status)
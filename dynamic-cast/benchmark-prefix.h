@@ -0,0 +1,9 @@
+// Everything harness.gen.cc and things.gen.cc need that doesn't change from
+// seed to seed. `generate-harness.py --pch --benchmark` puts this first in
+// both files, so that it can be compiled once into benchmark-prefix.h.gch.
+
+#include "dynamicast.h"
+#include "benchmark-harness.h"
+#include <cassert>
+#include <cstdio>
+#include <typeinfo>
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import argparse
+import imp
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GENERATE_HARNESS = os.path.join(HERE, 'generate-harness.py')
+
+generator = imp.load_source('generate_harness', GENERATE_HARNESS)
+
+
+def parse_int_list(s):
+    # "1-3,7" means [1, 2, 3, 7].
+    result = []
+    for part in s.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            result += range(int(lo), int(hi) + 1)
+        else:
+            result += [int(part)]
+    return result
+
+
+def config_key(num_classes, max_bases, mode):
+    return '%d classes, %d bases, %s' % (num_classes, max_bases, mode)
+
+
+def build_prerequisites():
+    # The same seed-independent objects that `make benchmark` uses.
+    subprocess.check_call([
+        'make', '-C', HERE, 'benchmark-prefix.h.gch', 'dynamicast.o',
+        'CXX=%s' % options.cxx, 'CXXFLAGS=%s' % options.cxxflags, 'BENCHMARK_FLAGS=%s' % options.benchmark_flags,
+    ], stdout=sys.stderr)
+
+
+def build_and_run(seed, num_classes, max_bases, mode, workdir):
+    random.seed(seed)
+    nodes = generator.populate(num_classes=num_classes, max_bases=max_bases)
+    generator.write_harness(nodes, workdir, benchmark=True, pch=True, tables=(mode == 'tables'))
+    bench = os.path.join(workdir, 'bench')
+    args = [options.cxx] + options.cxxflags.split() + ['-I', HERE] + [
+        os.path.join(workdir, 'harness.gen.cc'),
+        os.path.join(workdir, 'things.gen.cc'),
+        os.path.join(HERE, 'dynamicast.o'),
+    ] + options.benchmark_flags.split() + ['-o', bench]
+    # The generated classes provoke lots of warnings about inaccessible
+    # bases; show the compiler's output only if it fails.
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    compiler_output, _ = p.communicate()
+    if p.returncode != 0:
+        sys.stderr.write(compiler_output)
+        raise subprocess.CalledProcessError(p.returncode, args[0])
+    output = subprocess.check_output([
+        bench,
+        '--benchmark_format=json',
+        '--benchmark_repetitions=%d' % options.repetitions,
+        '--benchmark_min_time=%s' % options.min_time,
+    ])
+    return json.loads(output)['benchmarks']
+
+
+def get_ratios(benchmarks):
+    # Returns {class name: dynamicast time / native time}, using the median
+    # of the repetitions of each benchmark.
+    times = {}
+    for b in benchmarks:
+        if b.get('run_type', 'iteration') != 'iteration':
+            continue
+        m = re.match(r'BM_(native|dynamicast)_(\w+)$', b['name'])
+        if m is not None:
+            times.setdefault((m.group(2), m.group(1)), []).append(b['cpu_time'])
+    return dict(
+        (name, median(times[(name, 'dynamicast')]) / median(times[(name, 'native')]))
+        for name, kind in times if kind == 'native' and (name, 'dynamicast') in times
+    )
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+def median_confidence_interval(values):
+    # A distribution-free 95% interval for the median, from the order
+    # statistics that are about 1.96 standard deviations of Binomial(n, 1/2)
+    # either side of the middle.
+    values = sorted(values)
+    n = len(values)
+    half_width = 1.96 * math.sqrt(n) / 2
+    lo = max(0, int(math.floor(n / 2.0 - half_width)))
+    hi = min(n - 1, int(math.ceil(n / 2.0 + half_width)) - 1)
+    return values[lo], values[hi]
+
+
+def summarize(samples):
+    # samples is {config key: [ratio, ...]} over all seeds and classes.
+    summary = {}
+    for key, ratios in samples.iteritems():
+        lo, hi = median_confidence_interval(ratios)
+        summary[key] = {'samples': len(ratios), 'median': median(ratios), 'ci': [lo, hi]}
+    return summary
+
+
+def print_summary(summary, baseline, threshold):
+    # Returns the keys that regressed against the baseline.
+    regressions = []
+    print '%-32s %8s %8s %17s %10s' % ('configuration', 'samples', 'median', '95% CI', 'baseline')
+    for key in sorted(summary):
+        s = summary[key]
+        line = '%-32s %8d %8.2f %8.2f-%-8.2f' % (key, s['samples'], s['median'], s['ci'][0], s['ci'][1])
+        if key in baseline:
+            line += ' %10.2f' % baseline[key]['median']
+            if s['median'] > baseline[key]['median'] * (1 + threshold):
+                line += '  REGRESSION (+%.0f%%)' % (100 * (s['median'] / baseline[key]['median'] - 1))
+                regressions += [key]
+        print line
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeds', default='1-5', help='Seeds to benchmark, e.g. "1-5,9"')
+    parser.add_argument('--num-classes', default='10', help='Comma-separated numbers of classes to try')
+    parser.add_argument('--max-bases', default='3', help='Comma-separated numbers of base attempts to try')
+    parser.add_argument('--modes', default='ifs', help='Comma-separated typeinfo modes to try: ifs, tables')
+    parser.add_argument('--repetitions', type=int, default=3, metavar='N', help='Run each benchmark N times and take the median')
+    parser.add_argument('--min-time', default='0.05', metavar='SECONDS', help='Passed to --benchmark_min_time')
+    parser.add_argument('--cxx', default=os.environ.get('CXX', 'c++'), help='C++ compiler')
+    parser.add_argument('--cxxflags', default=os.environ.get('CXXFLAGS', '-std=c++1z -O2'), help='Flags for the C++ compiler')
+    parser.add_argument('--benchmark-flags', default=os.environ.get('BENCHMARK_FLAGS', '-I/usr/local/include -L/usr/local/lib -lbenchmark'), help='Flags for finding Google Benchmark')
+    parser.add_argument('--json', metavar='FILE', help='Also write every per-class ratio to FILE')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare the medians against a saved baseline')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Save the summary as a baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Flag a median ratio more than this fraction above the baseline')
+    options = parser.parse_args()
+
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    build_prerequisites()
+    workdir = tempfile.mkdtemp(prefix='benchmark-sweep-')
+    samples = {}
+    records = []
+    try:
+        configs = itertools.product(
+            parse_int_list(options.num_classes),
+            parse_int_list(options.max_bases),
+            options.modes.split(','),
+            parse_int_list(options.seeds),
+        )
+        for num_classes, max_bases, mode, seed in configs:
+            key = config_key(num_classes, max_bases, mode)
+            print >>sys.stderr, 'Benchmarking seed %d with %s...' % (seed, key)
+            ratios = get_ratios(build_and_run(seed, num_classes, max_bases, mode, workdir))
+            for name, ratio in sorted(ratios.iteritems()):
+                samples.setdefault(key, []).append(ratio)
+                records.append({
+                    'seed': seed, 'num_classes': num_classes, 'max_bases': max_bases, 'mode': mode,
+                    'class': name, 'ratio': ratio,
+                })
+    finally:
+        shutil.rmtree(workdir)
+
+    summary = summarize(samples)
+    regressions = print_summary(summary, baseline, options.threshold)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(records, f, indent=2, sort_keys=True)
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,64 @@
+#pragma once
+
+#include <algorithm>
+#include <cstring>
+#include <initializer_list>
+#include <typeinfo>
+#include <vector>
+
+// Lookup tables for the code that `generate-harness.py --tables` emits in
+// place of chains of `if (to == typeid(X)) ...`. Each table is sorted once,
+// when its function is first called, and then binary-searched, so a lookup
+// costs O(log n) type_info comparisons instead of O(n).
+
+struct TypeKey {
+    const std::type_info *first;
+    const std::type_info *second;  // nullptr if the key has only one type
+    int offset;
+};
+
+inline int compare_types(const std::type_info *a, const std::type_info *b) {
+    // The generated classes are all at namespace scope, so two of their
+    // type_infos are equal exactly when their names are. Comparing names
+    // three ways means each probe of the binary search costs one strcmp.
+    if (a == b) return 0;
+    if (a == nullptr) return -1;
+    if (b == nullptr) return 1;
+    return std::strcmp(a->name(), b->name());
+}
+
+inline bool operator<(const TypeKey& a, const TypeKey& b) {
+    if (int c = compare_types(a.first, b.first)) return c < 0;
+    if (int c = compare_types(a.second, b.second)) return c < 0;
+    return a.offset < b.offset;
+}
+
+template<class Value>
+class TypeTable {
+public:
+    struct Entry {
+        TypeKey key;
+        Value value;
+    };
+
+    TypeTable(std::initializer_list<Entry> entries) : entries_(entries) {
+        // A stable sort keeps the first of any duplicate keys first, just
+        // as the first matching `if` would win in the chained version.
+        std::stable_sort(entries_.begin(), entries_.end(), [](const Entry& a, const Entry& b) {
+            return a.key < b.key;
+        });
+    }
+
+    const Value *find(const TypeKey& key) const {
+        auto it = std::lower_bound(entries_.begin(), entries_.end(), key, [](const Entry& e, const TypeKey& k) {
+            return e.key < k;
+        });
+        if (it == entries_.end() || key < it->key) {
+            return nullptr;
+        }
+        return &it->value;
+    }
+
+private:
+    std::vector<Entry> entries_;
+};
@@ -1,71 +1,458 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
+import imp
+import json
+import math
+import multiprocessing
 import os
+import Queue
+import random
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
+import time
+import traceback
 
+HERE = os.path.dirname(os.path.abspath(__file__))
+GENERATE_HARNESS = os.path.join(HERE, 'generate-harness.py')
+UNITY_DUMP = os.path.join(HERE, '..', 'dependency-graph', 'unity-dump.py')
+LAST_SEED = long(1e12)
 
-def do_gcc_and_clang(seed):
+generator = imp.load_source('generate_harness', GENERATE_HARNESS)
+
+
+def unity_dump_args(workdir, backend):
+    # Run from workdir (see run_unity_dump), and search it before HERE, so
+    # that a stale things.gen.h left in HERE by `make local` can't shadow
+    # the one generated for this harness.
+    return [
+        UNITY_DUMP, '-I', workdir, '-I', HERE,
+        os.path.join(workdir, 'things.gen.cc'),
+        os.path.join(HERE, 'dynamicast.cc'),
+        os.path.join(workdir, 'harness.gen.cc'),
+        backend,
+    ] + unity_flags + (['--timings', os.path.join(workdir, 'timings.json')] if options.local else [])
+
+
+def run_unity_dump(workdir, backend, env=None):
+    subprocess.check_call(unity_dump_args(workdir, backend), stdout=dev_null, stderr=dev_null, env=env, cwd=workdir)
+
+
+def add_local_timings(workdir, stage, timings):
+    # With --local, unity-dump.py reports how long the compiler and the
+    # harness each took. A cached result took no time in this run, so it
+    # isn't counted.
+    fname = os.path.join(workdir, 'timings.json')
+    try:
+        with open(fname, 'r') as f:
+            local_timings = json.load(f)
+        os.remove(fname)
+    except (IOError, OSError, ValueError):
+        return
+    for t in local_timings.itervalues():
+        if t['cached']:
+            continue
+        for part in ('compile', 'run'):
+            if t[part] is not None:
+                timings[stage + '-' + part] = timings.get(stage + '-' + part, 0) + t[part]
+
+
+def populate(namespace=None):
+    return generator.populate(namespace, num_classes=options.num_classes, max_bases=options.max_bases)
+
+
+def generate(seeds, workdir, msvc):
+    # A single seed gets the same harness as "generate-harness.py --seed";
+    # a batch puts each seed's hierarchy in its own namespace.
+    generator.MSVC = msvc
+    nodes = []
+    for seed in seeds:
+        random.seed(seed)
+        nodes += populate(None if len(seeds) == 1 else 'seed%d' % seed)
+    generator.write_harness(nodes, workdir)
+
+
+@contextlib.contextmanager
+def timed(timings, stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + (time.time() - start)
+
+
+def do_gcc_and_clang(seeds, workdir, timings):
     failed = []
     try:
-        subprocess.check_call([
-            'python', 'generate-harness.py', '--seed', str(seed),
-        ], stdout=dev_null)
-        try:
-            subprocess.check_call([
-                '../dependency-graph/unity-dump.py',
-                'things.gen.cc', 'dynamicast.cc', 'harness.gen.cc',
-                '--g++',
-            ], stdout=dev_null, stderr=dev_null, env=gcc_env)
-            print >>sys.stderr, '.',
-        except subprocess.CalledProcessError:
-            failed += ['gcc']
-        try:
-            subprocess.check_call([
-                '../dependency-graph/unity-dump.py',
-                'things.gen.cc', 'dynamicast.cc', 'harness.gen.cc',
-                '--clang'
-            ], stdout=dev_null, stderr=dev_null, env=gcc_env)
-            print >>sys.stderr, '.',
-        except subprocess.CalledProcessError:
-            failed += ['clang']
+        with timed(timings, 'generate'):
+            generate(seeds, workdir, msvc=False)
+    except Exception:
+        return ['generator']
+    try:
+        with timed(timings, 'gcc'):
+            run_unity_dump(workdir, '--g++', gcc_env)
+        print >>sys.stderr, '.',
     except subprocess.CalledProcessError:
-        failed += ['generator']
+        failed += ['gcc']
+    add_local_timings(workdir, 'gcc', timings)
+    try:
+        with timed(timings, 'clang'):
+            run_unity_dump(workdir, '--clang', gcc_env)
+        print >>sys.stderr, '.',
+    except subprocess.CalledProcessError:
+        failed += ['clang']
+    add_local_timings(workdir, 'clang', timings)
     return failed
 
 
-def do_msvc(seed):
-    failed = []
+def do_msvc(seeds, workdir, timings):
     try:
-        subprocess.check_call([
-            'python', 'generate-harness.py', '--seed', str(seed), '--msvc',
-        ], stdout=dev_null)
-        try:
-            subprocess.check_call([
-                '../dependency-graph/unity-dump.py',
-                'things.gen.cc', 'dynamicast.cc', 'harness.gen.cc',
-                '--msvc'
-            ], stdout=dev_null, stderr=dev_null)
-            print >>sys.stderr, '.',
-        except subprocess.CalledProcessError:
-            failed += ['msvc']
+        with timed(timings, 'msvc-generate'):
+            generate(seeds, workdir, msvc=True)
+    except Exception:
+        return ['msvc-generator']
+    try:
+        with timed(timings, 'msvc'):
+            run_unity_dump(workdir, '--msvc')
+        print >>sys.stderr, '.',
     except subprocess.CalledProcessError:
-        failed += ['msvc-generator']
+        return ['msvc']
+    return []
+
+
+def check_batch(seeds, workdir, timings):
+    failed = []
+    failed += do_gcc_and_clang(seeds, workdir, timings)
+    if not options.local:
+        failed += do_msvc(seeds, workdir, timings)
     return failed
 
 
+def check_seeds(seeds, workdir, timings):
+    # Returns a list of (seed, failed) for the given seeds. A batch that
+    # fails is split in half and each half retried, until the failures
+    # are pinned on individual seeds.
+    failed = check_batch(seeds, workdir, timings)
+    if not failed:
+        return [(seed, []) for seed in seeds]
+    if len(seeds) == 1:
+        return [(seeds[0], failed)]
+    mid = len(seeds) // 2
+    results = check_seeds(seeds[:mid], workdir, timings) + check_seeds(seeds[mid:], workdir, timings)
+    if not any(f for _, f in results):
+        # Every seed passes on its own; blame the batch's first seed,
+        # so that the failure is at least reported.
+        results[0] = (seeds[0], ['%s-batch%d' % (f, len(seeds)) for f in failed])
+    return results
+
+
+def seen_key(digest):
+    # A hierarchy tested only by the local compilers hasn't been tested by
+    # gcc-head, clang-head or MSVC, so the seen-set is keyed by both.
+    return '%s %s' % (options.backends, digest)
+
+
+def check_batch_from(first_seed, seen, workdir):
+    # Returns (seed, failed, digest, timings) for each seed in the batch
+    # starting at first_seed. A seed whose hierarchy has already been
+    # tested on these backends is skipped, and gets a digest of None. The
+    # time spent on the batch (including any bisection) can't be divided
+    # fairly between its seeds, so it goes with the first seed only, and
+    # the others get timings of None.
+    seeds = range(first_seed, min(first_seed + options.batch, options.last_seed))
+    timings = {}
+    digests = {}
+    with timed(timings, 'populate'):
+        for seed in seeds:
+            random.seed(seed)
+            digest = generator.hierarchy_digest(populate())
+            if seen is None or seen.setdefault(seen_key(digest), seed) == seed:
+                digests[seed] = digest
+    fresh = [seed for seed in seeds if seed in digests]
+    failures = dict(check_seeds(fresh, workdir, timings)) if fresh else {}
+    return [(seed, failures.get(seed, []), digests.get(seed), timings if seed == first_seed else None) for seed in seeds]
+
+
+def worker(next_seed, seen, results):
+    # Each worker generates into its own scratch directory, and takes
+    # batches of seeds from the shared counter until they run out. If it
+    # fails, it sends (None, traceback) instead, so that the parent does
+    # not wait forever for the seeds it was testing.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workdir = tempfile.mkdtemp(prefix='find-bugs-')
+    try:
+        while True:
+            with next_seed.get_lock():
+                seed = next_seed.value
+                next_seed.value += options.batch
+            if seed >= options.last_seed:
+                break
+            for result in check_batch_from(seed, seen, workdir):
+                results.put(result)
+    except Exception:
+        results.put((None, traceback.format_exc()))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def report(seed, failed):
+    if failed:
+        print '%s: %d' % ('+'.join(failed), seed)
+        sys.stdout.flush()
+
+
+def load_seen_file(fname):
+    try:
+        with open(fname, 'r') as f:
+            return dict((line.strip(), None) for line in f if line.strip())
+    except IOError:
+        return {}
+
+
+def campaign_params():
+    # The options that change what a seed tests; each log record carries
+    # them, so that campaigns of different shapes can share a log.
+    return {'num_classes': options.num_classes, 'max_bases': options.max_bases, 'local': options.local}
+
+
+def format_params(params):
+    return ' '.join('%s=%s' % (k, '?' if params.get(k) is None else params[k]) for k in sorted(campaign_params()))
+
+
+def read_last_logged_record(fname):
+    # The log is written in seed order, so the last complete line holds the
+    # last completed seed. Only the tail of the file needs to be read.
+    try:
+        with open(fname, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 65536))
+            lines = f.read().splitlines()
+    except IOError:
+        return None
+    for line in reversed(lines):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # a partly written line, from a campaign that was killed
+        if 'seed' in record:
+            return record
+    return None
+
+
+def open_log(fname):
+    f = open(fname, 'a+')
+    f.seek(0, os.SEEK_END)
+    if f.tell() > 0:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != '\n':
+            f.write('\n')  # finish off a partly written line
+    return f
+
+
+def read_log(fname):
+    records = []
+    with open(fname, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(math.ceil(p / 100.0 * len(sorted_values))) - 1))]
+
+
+def print_summary(records):
+    # Campaigns with different parameters aren't comparable, so each set
+    # of parameters gets its own summary.
+    groups = {}
+    for r in records:
+        params = dict((k, r.get(k)) for k in campaign_params())
+        groups.setdefault(format_params(params), []).append(r)
+    for i, key in enumerate(sorted(groups)):
+        if i > 0:
+            print
+        print '%s:' % key
+        print_group_summary(groups[key])
+
+
+def print_group_summary(records):
+    # Each run's active time is from its start until its last record, so
+    # that the gaps between resumed runs don't count.
+    last_time_of_run = {}
+    for r in records:
+        last_time_of_run[r['run']] = max(last_time_of_run.get(r['run'], r['run']), r['time'])
+    elapsed = max(sum(t - run for run, t in last_time_of_run.iteritems()), 1e-6)
+    unique = sum(1 for r in records if r['digest'] is not None)
+    print '%d seeds (%.2f/s), %d unique hierarchies (%.2f/s), %d skipped, in %d runs' % (
+        len(records), len(records) / elapsed, unique, unique / elapsed, len(records) - unique, len(last_time_of_run),
+    )
+
+    stage_times = {}
+    for r in records:
+        for stage, t in (r['timings'] or {}).iteritems():
+            stage_times.setdefault(stage, []).append(t)
+    print
+    print '%-16s %8s %10s %10s %10s' % ('stage', 'batches', 'p50 (s)', 'p99 (s)', 'total (s)')
+    for stage in sorted(stage_times):
+        values = sorted(stage_times[stage])
+        print '%-16s %8d %10.3f %10.3f %10.1f' % (stage, len(values), percentile(values, 50), percentile(values, 99), sum(values))
+
+    failure_counts = {}
+    for r in records:
+        for backend in r['failed']:
+            failure_counts[backend] = failure_counts.get(backend, 0) + 1
+    print
+    print '%-16s %8s' % ('backend', 'failures')
+    for backend in sorted(failure_counts):
+        print '%-16s %8d' % (backend, failure_counts[backend])
+
+
+class Progress(object):
+    # Reports each seed's result, appends it to the campaign log, appends
+    # each newly checked hierarchy to the seen-file, and periodically prints
+    # raw-seed and unique-hierarchy rates.
+    def __init__(self, log_file, seen_file, interval=60):
+        self.log_file = log_file
+        self.seen_file = seen_file
+        self.interval = interval
+        self.start = self.last_printed = time.time()
+        self.seeds = 0
+        self.unique = 0
+
+    def record(self, seed, failed, digest, timings):
+        report(seed, failed)
+        self.seeds += 1
+        if digest is not None:
+            self.unique += 1
+            if self.seen_file is not None:
+                print >>self.seen_file, seen_key(digest)
+                self.seen_file.flush()
+        record = {
+            'seed': seed,
+            'run': self.start,
+            'time': time.time(),
+            'batch': options.batch,
+            'failed': failed,
+            'digest': digest,
+            'timings': timings,
+        }
+        record.update(campaign_params())
+        print >>self.log_file, json.dumps(record, sort_keys=True)
+        self.log_file.flush()
+        if time.time() - self.last_printed >= self.interval:
+            self.print_throughput()
+
+    def print_throughput(self):
+        self.last_printed = time.time()
+        elapsed = max(self.last_printed - self.start, 1e-6)
+        print >>sys.stderr, '\n%d seeds (%.2f/s), %d unique hierarchies (%.2f/s)' % (
+            self.seeds, self.seeds / elapsed, self.unique, self.unique / elapsed,
+        )
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--seed', type=int, default=1, help='Initial seed (and we count upward from there)')
+    parser.add_argument('--seed', type=int, default=None, help='Initial seed (and we count upward from there); by default, resume after the last seed in the log')
+    parser.add_argument('--count', type=int, default=None, metavar='N', help='Stop after N seeds (by default, keep going)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='Test N seeds at once')
+    parser.add_argument('--num-classes', type=int, default=10, metavar='N', help='Number of classes in each hierarchy')
+    parser.add_argument('--max-bases', type=int, default=3, metavar='N', help='Number of attempts to add a random base to each class')
+    parser.add_argument('--batch', type=int, default=1, metavar='K', help='Test K seeds in each harness, in separate namespaces')
+    parser.add_argument('--seen-file', default='.find-bugs-seen', metavar='FILE', help='File of hierarchy digests already tested on the same backends, which are skipped')
+    parser.add_argument('--no-dedupe', action='store_true', help='Test every seed, even if an isomorphic hierarchy was already tested')
+    parser.add_argument('--log', default='.find-bugs-log.jsonl', metavar='FILE', help='Campaign log, with one JSON record per seed (and stage timings per batch)')
+    parser.add_argument('--summary', action='store_true', help='Summarize the campaign log and exit')
+    parser.add_argument('--local', action='store_true', help='Compile with the local clang++ and g++, and skip MSVC')
     options = parser.parse_args()
 
+    if options.summary:
+        print_summary(read_log(options.log))
+        sys.exit(0)
+
+    if options.seed is None:
+        last = read_last_logged_record(options.log)
+        if last is None:
+            options.seed = 1
+        else:
+            # Resuming with different parameters would skip seeds that
+            # were never tested with these ones.
+            params = dict((k, last.get(k)) for k in campaign_params())
+            if params != campaign_params():
+                print >>sys.stderr, 'The last campaign in %s used %s, not %s; pass --seed to start a new campaign' % (
+                    options.log, format_params(params), format_params(campaign_params()),
+                )
+                sys.exit(1)
+            options.seed = last['seed'] + 1
+            print >>sys.stderr, 'Resuming after seed %d' % last['seed']
+    options.last_seed = LAST_SEED if options.count is None else min(options.seed + options.count, LAST_SEED)
+
     dev_null = open('/dev/null', 'w')
     gcc_env = os.environ.copy()
     gcc_env['CXXFLAGS'] = '-DFREE_USE_OF_CXX17'
-    for i in xrange(options.seed, long(1e12)):
-        failed = []
-        failed += do_gcc_and_clang(i)
-        failed += do_msvc(i)
-        if failed:
-            print '%s: %d' % ('+'.join(failed), i)
+    unity_flags = ['--local'] if options.local else []
+    options.backends = 'local-gcc+local-clang' if options.local else 'gcc-head+clang-head+msvc'
+
+    log_file = open_log(options.log)
+    if options.no_dedupe:
+        seen = None
+        progress = Progress(log_file, None)
+    else:
+        seen = load_seen_file(options.seen_file)
+        progress = Progress(log_file, open(options.seen_file, 'a'))
+
+    if options.jobs <= 1:
+        workdir = tempfile.mkdtemp(prefix='find-bugs-')
+        try:
+            for i in xrange(options.seed, options.last_seed, options.batch):
+                for result in check_batch_from(i, seen, workdir):
+                    progress.record(*result)
+        finally:
+            shutil.rmtree(workdir)
+            progress.print_throughput()
+        sys.exit(0)
+
+    # The workers share one seen-set, so that two of them never test the
+    # same hierarchy at once; only this process writes the seen-file.
+    if seen is not None:
+        manager = multiprocessing.Manager()
+        seen = manager.dict(seen)
+    next_seed = multiprocessing.Value('L', options.seed)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=worker, args=(next_seed, seen, results)) for _ in xrange(options.jobs)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    # Seeds finish out of order; hold each result until every earlier seed
+    # has been reported, so that failures come out in seed order.
+    finished = {}
+    next_to_report = options.seed
+    try:
+        while next_to_report < options.last_seed:
+            try:
+                result = results.get(timeout=1)
+            except Queue.Empty:
+                # A worker killed outright (e.g. by the OOM killer) can't
+                # send anything, so check on them now and then.
+                if any(w.exitcode not in (None, 0) for w in workers):
+                    print >>sys.stderr, '\nA worker died unexpectedly'
+                    sys.exit(1)
+                continue
+            if result[0] is None:
+                print >>sys.stderr, '\nA worker failed:\n%s' % result[1]
+                sys.exit(1)
+            finished[result[0]] = result[1:]
+            while next_to_report in finished:
+                progress.record(next_to_report, *finished.pop(next_to_report))
+                next_to_report += 1
+    finally:
+        for w in workers:
+            w.terminate()
+        progress.print_throughput()
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 import argparse
+import hashlib
+import os
 import random
+import re
 
 DEBUG = False
 MSVC = False
@@ -14,15 +17,6 @@ class Subobject(object):
         self.direct_subobject_of = direct_subobject_of
         self.direct_superobject_of = []
 
-    def has_public_path_down_to(self, root):
-        if self == root:
-            return True
-        for dso in self.direct_subobject_of:
-            if dso.base.has_direct_public_base(self.base):
-                if dso.has_public_path_down_to(root):
-                    return True
-        return False
-
 
 class LayoutState(object):
     def __init__(self, root):
@@ -32,6 +26,12 @@ class LayoutState(object):
         self.offset = 0
         self.public_child_pairs = set()
         self.ambiguous_public_child_pairs = set()
+        self.index_of = {}
+        self.public_bases = []
+        self.nonpublic_bases = []
+        self.count_of_type = {}
+        self.public_base_types = set()
+        self.nonpublic_base_types = set()
 
     def populate_superobjects(self):
         for p in self.layout:
@@ -40,6 +40,24 @@ class LayoutState(object):
         for p in self.layout:
             p.direct_superobject_of = sorted(p.direct_superobject_of, key=lambda so: p.base.inheritance_order_of(so.base))
 
+    def compute_public_reachability(self):
+        # reaches[i] is a bitmask of the subobjects that layout[i] has a
+        # public path down to (including itself). Each subobject's mask is
+        # computed once, from the masks of its direct subobject-ofs.
+        reaches = [None] * len(self.layout)
+        def visit(so):
+            i = self.index_of[so]
+            if reaches[i] is None:
+                mask = 1 << i
+                for dso in so.direct_subobject_of:
+                    if dso.base.has_direct_public_base(so.base):
+                        mask |= visit(dso)
+                reaches[i] = mask
+            return reaches[i]
+        for so in self.layout:
+            visit(so)
+        return reaches
+
     def print_layout(self):
         for so in self.layout:
             print '%3d: %s%s' % (so.offset, so.base.name, ' (virtual)' if so.is_virtual else '')
@@ -48,15 +66,28 @@ class LayoutState(object):
 
 
 class Node(object):
-    def __init__(self, name):
+    def __init__(self, name, namespace=None):
         self.name = name
+        self.namespace = namespace
         self.direct_bases = []
         self.state = None
+        self.ancestors = None
+        self.virtual_bases = None
+
+    def qualified_name(self):
+        if self.namespace is None:
+            return self.name
+        return '%s::%s' % (self.namespace, self.name)
 
     def has_ancestor(self, base):
-        if self == base:
-            return True
-        return any(b.base.has_ancestor(base) for b in self.direct_bases)
+        return base in self.get_ancestors()
+
+    def get_ancestors(self):
+        if self.ancestors is None:
+            self.ancestors = set([self])
+            for b in self.direct_bases:
+                self.ancestors |= b.base.get_ancestors()
+        return self.ancestors
 
     def maybe_add_base(self, base, is_virtual, is_public):
         if all(b.base != base for b in self.direct_bases):
@@ -69,15 +100,24 @@ class Node(object):
                 return i
         return None
 
-    def get_all_virtual_bases(self, acc):
-        for b in self.direct_bases:
-            if MSVC:
-                acc = b.base.get_all_virtual_bases(acc)
-            if b.is_virtual and b.base not in acc:
-                acc += [b.base]
-            if not MSVC:
-                acc = b.base.get_all_virtual_bases(acc)
-        return acc
+    def get_all_virtual_bases(self):
+        # In the order they are laid out: each base's own virtual bases come
+        # before it under MSVC, and after it under Itanium.
+        if self.virtual_bases is None:
+            result = []
+            seen = set()
+            for b in self.direct_bases:
+                candidates = [b.base] if b.is_virtual else []
+                if MSVC:
+                    candidates = b.base.get_all_virtual_bases() + candidates
+                else:
+                    candidates = candidates + b.base.get_all_virtual_bases()
+                for base in candidates:
+                    if base not in seen:
+                        seen.add(base)
+                        result += [base]
+            self.virtual_bases = result
+        return self.virtual_bases
 
     def has_direct_public_base(self, base):
         return any(b.base == base for b in self.direct_bases if b.is_public)
@@ -86,10 +126,19 @@ class Node(object):
         return any(b.base == base for b in self.direct_bases if b.is_virtual)
 
     def is_ambiguous_base(self, base):
-        return len([so for so in self.get_class_layout() if so.base == base]) >= 2
+        state = self.get_populated_layout_state()
+        return state.count_of_type.get(base, 0) >= 2
+
+    def has_public_base(self, base):
+        state = self.get_populated_layout_state()
+        return base in state.public_base_types
+
+    def has_nonpublic_base(self, base):
+        state = self.get_populated_layout_state()
+        return base in state.nonpublic_base_types
 
     def has_any_virtual_bases(self):
-        return bool(self.get_all_virtual_bases([]))
+        return bool(self.get_all_virtual_bases())
 
     def layout_(self, state, from_subobject, include_virtual_bases):
         for b in self.direct_bases:
@@ -111,24 +160,39 @@ class Node(object):
             state.offset += 8  # for my data
 
         if include_virtual_bases:
-            for base in self.get_all_virtual_bases([]):
+            for base in self.get_all_virtual_bases():
                 so = Subobject(base, is_virtual=True, offset=state.offset, direct_subobject_of=[])
                 state.layout += [so]
                 so.base.layout_(state, from_subobject=so, include_virtual_bases=False)
+            having_direct_virtual_base = {}
+            for childso in state.layout:
+                for b in childso.base.direct_bases:
+                    if b.is_virtual:
+                        having_direct_virtual_base.setdefault(b.base, []).append(childso)
             for parentso in state.layout[1:]:
                 if parentso.is_virtual:
-                    for childso in state.layout:
-                        if childso.base.has_direct_virtual_base(parentso.base):
-                            parentso.direct_subobject_of += [childso]
+                    parentso.direct_subobject_of += having_direct_virtual_base.get(parentso.base, [])
         return
 
     def generate_base_paths(self, acc, f):
-        yield acc
-        for b in self.direct_bases:
-            if self.is_ambiguous_base(b.base):
-                continue
-            for p in b.base.generate_base_paths(acc + f(b), f):
-                yield p
+        # Yields a path of as_X() calls to each distinct (type, offset)
+        # subobject of a complete self. A path reaching a subobject that an
+        # earlier path already reached would test the same casts, and so
+        # would every path extending it, so those are pruned; in diamonds
+        # this turns exponentially many paths into one per subobject.
+        seen = set()
+        def visit(so, acc):
+            seen.add((so.base, so.offset))
+            yield acc
+            for b in so.base.direct_bases:
+                if so.base.is_ambiguous_base(b.base):
+                    continue
+                bso = next(c for c in so.direct_superobject_of if c.base == b.base)
+                if (bso.base, bso.offset) not in seen:
+                    for p in visit(bso, acc + f(b)):
+                        yield p
+        state = self.get_populated_layout_state()
+        return visit(state.root_subobject, acc)
 
     def get_class_layout(self):
         state = self.get_populated_layout_state()
@@ -140,15 +204,11 @@ class Node(object):
 
     def get_public_bases(self):
         state = self.get_populated_layout_state()
-        for so in state.layout[1:]:
-            if so.has_public_path_down_to(state.root_subobject):
-                yield so
+        return iter(state.public_bases)
 
     def get_nonpublic_bases(self):
         state = self.get_populated_layout_state()
-        for so in state.layout[1:]:
-            if not so.has_public_path_down_to(state.root_subobject):
-                yield so
+        return iter(state.nonpublic_bases)
 
     def get_unambiguous_public_bases(self):
         for so in self.get_public_bases():
@@ -165,27 +225,41 @@ class Node(object):
 
             state.populate_superobjects()
 
-            state.public_child_pairs = set()
-            for p in state.layout[1:]:
-                for c in state.layout[1:]:
-                    # Notice it is possible for p (the more-leaflike of the two) to be laid out
-                    # physically-before some of p's children if those children are themselves virtual.
-                    pc = (p, c)
-                    if p != c and p.has_public_path_down_to(c):
-                        state.public_child_pairs.add(pc)
+            state.index_of = dict((so, i) for i, so in enumerate(state.layout))
+            for so in state.layout:
+                state.count_of_type[so.base] = state.count_of_type.get(so.base, 0) + 1
+            reaches = state.compute_public_reachability()
+            for i, so in enumerate(state.layout[1:], 1):
+                if reaches[i] & 1:
+                    state.public_bases += [so]
+                    state.public_base_types.add(so.base)
+                else:
+                    state.nonpublic_bases += [so]
+                    state.nonpublic_base_types.add(so.base)
 
+            state.public_child_pairs = set()
             state.ambiguous_public_child_pairs = set()
-            for (parent, child) in state.public_child_pairs:
-                descendants_of_child_type = sum(1 for p, c in state.public_child_pairs if p == parent and c.base == child.base)
-                if descendants_of_child_type >= 2:
-                    state.ambiguous_public_child_pairs.add((parent, child))
+            for i, p in enumerate(state.layout[1:], 1):
+                # Notice it is possible for p (the more-leaflike of the two) to be laid out
+                # physically-before some of p's children if those children are themselves virtual.
+                children = [state.layout[j] for j in iter_bits(reaches[i] & ~(1 | (1 << i)))]
+                descendants_of_type = {}
+                for c in children:
+                    descendants_of_type[c.base] = descendants_of_type.get(c.base, 0) + 1
+                for c in children:
+                    state.public_child_pairs.add((p, c))
+                    if descendants_of_type[c.base] >= 2:
+                        state.ambiguous_public_child_pairs.add((p, c))
             self.state = state
             DEBUG=False
         return self.state
 
     def get_public_child_pairs(self):
         state = self.get_populated_layout_state()
-        return sorted(state.public_child_pairs - state.ambiguous_public_child_pairs)
+        return sorted(
+            state.public_child_pairs - state.ambiguous_public_child_pairs,
+            key=lambda (p, c): (state.index_of[p], state.index_of[c]),
+        )
 
 
 class Edge(object):
@@ -202,22 +276,56 @@ class Edge(object):
         )
 
 
+def iter_bits(mask):
+    # Yields the index of each set bit, lowest first.
+    s = bin(mask)[:1:-1]
+    i = s.find('1')
+    while i >= 0:
+        yield i
+        i = s.find('1', i + 1)
+
+
 def tf():
     return random.choice([True, False])
 
 
-def populate():
+def populate(namespace=None, num_classes=10, max_bases=3):
     nodes = []
-    for i in xrange(10):
-        newclass = Node('Class%d' % (i + 1))
+    for i in xrange(num_classes):
+        newclass = Node('Class%d' % (i + 1), namespace)
         if i >= 3:
-            for j in xrange(3):
+            for j in xrange(max_bases):
                 if nodes:
                     newclass.maybe_add_base(random.choice(nodes), is_virtual=tf(), is_public=tf())
         nodes += [newclass]
     return nodes
 
 
+def canonical_form(node):
+    # The hierarchy above `node`, with its classes numbered in depth-first
+    # order of their bases. Class names don't appear, but base order does,
+    # because it determines the layout.
+    index = {}
+    order = []
+    def visit(n):
+        index[n] = len(order)
+        order.append(n)
+        for b in n.direct_bases:
+            if b.base not in index:
+                visit(b.base)
+    visit(node)
+    return tuple(
+        tuple((index[b.base], b.is_virtual, b.is_public) for b in n.direct_bases)
+        for n in order
+    )
+
+
+def hierarchy_digest(nodes):
+    # Hierarchies that differ only in class names or in the order the
+    # classes are defined test exactly the same casts, and share a digest.
+    return hashlib.sha1(repr(sorted(canonical_form(n) for n in nodes))).hexdigest()
+
+
 def class_definition(node):
     def as_foo(name):
         return '%s *as_%s() { return this; }' % (name, name)
@@ -311,72 +419,161 @@ const MyTypeInfo& awkward_typeinfo_conversion(const std::type_info& ti) {%s
 }
     '''.strip() % (
         ''.join(
-            '\n    if (ti == typeid(%s)) return %s_typeinfo;' % (n.name, n.name)
+            '\n    if (ti == typeid(%s)) return %s_typeinfo;' % (n.qualified_name(), n.qualified_name())
+            for n in nodes
+        )
+    )
+
+
+def typeinfo_table_definition(node):
+    # The same three functions as typeinfo_definition, but looking up
+    # sorted tables from dynamicast-tables.h instead of chaining ifs.
+    def table(value_type, entries):
+        return 'static const TypeTable<%s> table = {%s\n    };' % (
+            value_type,
+            ''.join('\n        {{%s}, %s},' % entry for entry in entries),
+        )
+
+    result = '''
+void *%s_convertToBase(char *p, const std::type_info& to) {
+    %s
+    const int *offset = table.find({&to, nullptr, 0});
+    return offset ? p + *offset : nullptr;
+}
+    '''.strip() % (
+        node.name,
+        table('int', [
+            ('&typeid(%s), nullptr, 0' % so.base.name, so.offset)
+            for so in node.get_unambiguous_public_bases()
+        ]),
+    ) + '\n'
+    result += '''
+void *%s_maybeFromHasAPublicChildOfTypeTo(char *p, int offset, const std::type_info& from, const std::type_info& to) {
+    %s
+    const int *to_offset = table.find({&from, &to, offset});
+    return to_offset ? p + *to_offset : nullptr;
+}
+    '''.strip() % (
+        node.name,
+        table('int', [
+            ('&typeid(%s), &typeid(%s), %d' % (f.base.name, t.base.name, f.offset), t.offset)
+            for f, t in node.get_public_child_pairs()
+        ]),
+    ) + '\n'
+    result += '''
+bool %s_isPublicBaseOfYourself(int offset, const std::type_info& from) {
+    %s
+    if (const bool *is_public = table.find({&from, nullptr, offset})) return *is_public;
+    printf("unexpectedly %%d %%s\\n", offset, from.name());
+    assert(false);
+    return false;
+}
+    '''.strip() % (
+        node.name,
+        table('bool', [
+            ('&typeid(%s), nullptr, %d' % (so.base.name, so.offset), 'true')
+            for so in node.get_public_bases()
+        ] + [
+            ('&typeid(%s), nullptr, %d' % (so.base.name, so.offset), 'false')
+            for so in node.get_nonpublic_bases()
+        ]),
+    ) + '\n'
+    result += '''
+MyTypeInfo %s_typeinfo {
+    %s_convertToBase,
+    %s_maybeFromHasAPublicChildOfTypeTo,
+    %s_isPublicBaseOfYourself,
+};
+    '''.strip() % (
+        node.name,
+        node.name,
+        node.name,
+        node.name,
+    ) + '\n'
+    return result
+
+
+def dispatcher_table_definition(nodes):
+    return '''
+const MyTypeInfo& awkward_typeinfo_conversion(const std::type_info& ti) {
+    static const TypeTable<const MyTypeInfo *> table = {%s
+    };
+    const MyTypeInfo *const *result = table.find({&ti, nullptr, 0});
+    assert(result != nullptr);
+    return **result;
+}
+    '''.strip() % (
+        ''.join(
+            '\n        {{&typeid(%s), nullptr, 0}, &%s_typeinfo},' % (n.qualified_name(), n.qualified_name())
             for n in nodes
         )
     )
 
 
 def help_msvc_with_sfinae(nodes):
-    result = ''
     for f in nodes:
-        result += 'template<> struct can_dynamic_cast<%s*, void*> : std::true_type {};\n' % f.name
+        yield 'template<> struct can_dynamic_cast<%s*, void*> : std::true_type {};\n' % f.qualified_name()
         for t in nodes:
             if f == t:
                 can_dynamic_cast = True
             elif f.is_ambiguous_base(t):
                 can_dynamic_cast = False
-            elif any(so.base == t for so in f.get_public_bases()):
+            elif f.has_public_base(t):
                 can_dynamic_cast = True
-            elif any(so.base == t for so in f.get_nonpublic_bases()):
+            elif f.has_nonpublic_base(t):
                 can_dynamic_cast = False
             else:
                 can_dynamic_cast = True
-            result += 'template<> struct can_dynamic_cast<%s*, %s*> : std::%s {};\n' % (
-                f.name,
-                t.name,
+            yield 'template<> struct can_dynamic_cast<%s*, %s*> : std::%s {};\n' % (
+                f.qualified_name(),
+                t.qualified_name(),
                 'true_type' if can_dynamic_cast else 'false_type',
             )
-    return result
 
 
-def test_to_function_definition(nodes):
-    result = '''
-template<class To>
-void test_to() {
-    '''.strip() + '\n'
-    for n in nodes:
-        for path in n.generate_base_paths('instance<%s>()' % n.name, lambda b: '->as_%s()' % b.base.name):
-            result += '    test<To>(can_dynamic_cast<decltype(%s),To*>{}, %s, instance<%s>()->as_charptr(), "%s");\n' % (path, path, n.name, path)
+def sample_base_paths(node, max_paths=None, seed=None):
+    # The paths from instance<node>() to each of its subobjects, or if there
+    # are more than max_paths of them, a sample of max_paths in their usual
+    # order. Each class is sampled with its own Random, seeded from `seed`
+    # and its name, so that sharding the harness does not change the sample.
+    paths = list(node.generate_base_paths('instance<%s>()' % node.name, lambda b: '->as_%s()' % b.base.name))
+    if max_paths is None or len(paths) <= max_paths:
+        return paths
+    rng = random.Random(int(hashlib.sha1('%s/%s' % (seed, node.qualified_name())).hexdigest(), 16))
+    return [paths[i] for i in sorted(rng.sample(xrange(len(paths)), max_paths))]
 
-    result += '}\n'
-    return result
+
+def test_to_function_definition(nodes, name='test_to', max_paths=None, seed=None):
+    yield 'template<class To>\nvoid %s() {\n' % name
+    for n in nodes:
+        for path in sample_base_paths(n, max_paths, seed):
+            yield '    test<To>(can_dynamic_cast<decltype(%s),To*>{}, %s, instance<%s>()->as_charptr(), "%s");\n' % (path, path, n.name, path)
+    yield '}\n'
 
 
 def test_main_function_definition(nodes):
+    calls = []
+    for namespace, group in group_by_namespace(nodes):
+        test_to = 'test_to' if namespace is None else '%s::test_to' % namespace
+        calls += ['    %s<void>();' % test_to]
+        calls += ['    %s<%s>();' % (test_to, n.qualified_name()) for n in group]
     return '''
 int main() {
-    test_to<void>();
 %s
     printf("%%d failures.\\n", failure_count());
     return failure_count() ? 1 : 0;
 }
     '''.strip() % (
-        '\n'.join('    test_to<%s>();' % n.name for n in nodes)
+        '\n'.join(calls)
     )
 
 
-def benchmark_to_function_definition(nodes):
-    result = '''
-template<class To, class Native>
-void benchmark_to(Native n) {
-    '''.strip() + '\n'
+def benchmark_to_function_definition(nodes, name='benchmark_to', max_paths=None, seed=None):
+    yield 'template<class To, class Native>\nvoid %s(Native n) {\n' % name
     for n in nodes:
-        for path in n.generate_base_paths('instance<%s>()' % n.name, lambda b: '->as_%s()' % b.base.name):
-            result += '    run_benchmark<To>(n, %s);\n' % (path)
-
-    result += '}\n'
-    return result
+        for path in sample_base_paths(n, max_paths, seed):
+            yield '    run_benchmark<To>(n, %s);\n' % (path)
+    yield '}\n'
 
 
 def benchmark_main_function_definition(nodes):
@@ -389,41 +586,197 @@ BENCHMARK_MAIN();
     )
 
 
+def shard_name(name, k):
+    return '%s_shard%d' % (name, k)
+
+
+def sharded_function_definition(name, shards, benchmark):
+    # Declares the per-shard pieces of test_to or benchmark_to, which are
+    # instantiated in the harness.gen.<k>.cc files, and calls them in order.
+    if benchmark:
+        template, parameters, arguments = 'template<class To, class Native>', 'Native n', 'n'
+    else:
+        template, parameters, arguments = 'template<class To>', '', ''
+    for k in xrange(shards):
+        yield '%s void %s(%s);\n' % (template, shard_name(name, k), parameters)
+    yield '\n%s\nvoid %s(%s) {\n' % (template, name, parameters)
+    for k in xrange(shards):
+        yield '    %s<To>(%s);\n' % (shard_name(name, k), arguments)
+    yield '}\n'
+
+
+def explicit_instantiations(name, nodes, benchmark):
+    for to in ['void'] + [n.name for n in nodes]:
+        if benchmark:
+            for native in ['std::true_type', 'std::false_type']:
+                yield 'template void %s<%s, %s>(%s);\n' % (name, to, native, native)
+        else:
+            yield 'template void %s<%s>();\n' % (name, to)
+
+
+def typeinfo_declarations(nodes):
+    for n in nodes:
+        yield 'extern MyTypeInfo %s_typeinfo;\n' % n.name
+
+
+def group_by_namespace(nodes):
+    result = []
+    for n in nodes:
+        if not result or result[-1][0] != n.namespace:
+            result += [(n.namespace, [])]
+        result[-1][1].append(n)
+    return result
+
+
+def split_into_shards(nodes, shards):
+    # Contiguous runs of classes, so that a sharded harness runs its tests
+    # in the same order as an unsharded one.
+    return [nodes[len(nodes) * k // shards:len(nodes) * (k + 1) // shards] for k in xrange(shards)]
+
+
+def write_chunks(f, chunks):
+    # The emitters yield their output piece by piece, so that the code for
+    # a large hierarchy is streamed to disk rather than built up in memory.
+    for chunk in chunks:
+        f.write(chunk)
+    f.write('\n')
+
+
+def open_namespace(f, namespace):
+    if namespace is not None:
+        print >>f, 'namespace %s {\n' % namespace
+
+
+def close_namespace(f, namespace):
+    if namespace is not None:
+        print >>f, '} // namespace %s\n' % namespace
+
+
+def remove_stale_shards(output_dir, shards):
+    # Remove the shards of an earlier, more finely sharded harness, so that
+    # a build which globs for *.gen*.cc does not pick them up.
+    for fname in os.listdir(output_dir):
+        m = re.match(r'(things|harness)\.gen\.(\d+)\.cc$', fname)
+        if m is not None and int(m.group(2)) >= shards:
+            os.remove(os.path.join(output_dir, fname))
+
+
+def write_harness(nodes, output_dir, benchmark=False, pch=False, tables=False, shards=1, max_paths=None, path_seed=None):
+    # Write things.gen.h, things.gen.cc, and harness.gen.cc for the given
+    # hierarchy. Nodes from several populate(namespace=...) calls can be
+    # concatenated to test many hierarchies in a single harness.
+    #
+    # With shards > 1, the typeinfo definitions move into things.gen.<k>.cc
+    # and the body of test_to or benchmark_to is split across
+    # harness.gen.<k>.cc, for k in 0 ... shards-1, so that the translation
+    # units can be compiled in parallel.
+    #
+    # With max_paths, each class's casts are tested from at most that many
+    # of its subobjects, chosen deterministically from path_seed.
+    if benchmark and any(n.namespace is not None for n in nodes):
+        raise ValueError('The benchmark harness does not support namespaced hierarchies')
+    if shards < 1:
+        raise ValueError('The harness needs at least one shard')
+    prefix_h = 'benchmark-prefix.h' if benchmark else 'test-prefix.h'
+    harness_h = 'benchmark-harness.h' if benchmark else 'test-harness.h'
+    typeinfo = typeinfo_table_definition if tables else typeinfo_definition
+    function_name = 'benchmark_to' if benchmark else 'test_to'
+    function_definition = benchmark_to_function_definition if benchmark else test_to_function_definition
+    groups = group_by_namespace(nodes)
+
+    def print_things_prologue(f):
+        if pch:
+            print >>f, '#include "%s"' % prefix_h
+        print >>f, '#include "things.gen.h"'
+        print >>f, '#include "dynamicast.h"'
+        print >>f, '#include <cassert>'
+        print >>f, '#include <cstdio>'
+        if tables:
+            print >>f, '#include <typeinfo>'
+            print >>f, '#include "dynamicast-tables.h"\n'
+        else:
+            print >>f, '#include <typeinfo>\n'
+
+    def print_harness_prologue(f):
+        if pch:
+            print >>f, '#include "%s"' % prefix_h
+        print >>f, '#include "things.gen.h"'
+        print >>f, '#include "dynamicast.h"'
+        print >>f, '#include "%s"\n' % harness_h
+
+    remove_stale_shards(output_dir, shards if shards > 1 else 0)
+    with open(os.path.join(output_dir, 'things.gen.h'), 'w') as things_h:
+        for namespace, group in groups:
+            open_namespace(things_h, namespace)
+            for n in group:
+                print >>things_h, class_definition(n)
+            close_namespace(things_h, namespace)
+    with open(os.path.join(output_dir, 'things.gen.cc'), 'w') as things_cc:
+        print_things_prologue(things_cc)
+        for namespace, group in groups:
+            open_namespace(things_cc, namespace)
+            if shards > 1:
+                write_chunks(things_cc, typeinfo_declarations(group))
+            else:
+                for n in group:
+                    print >>things_cc, typeinfo(n)
+            close_namespace(things_cc, namespace)
+        print >>things_cc, dispatcher_table_definition(nodes) if tables else dispatcher_definition(nodes)
+    for k in xrange(shards if shards > 1 else 0):
+        name = shard_name(function_name, k)
+        with open(os.path.join(output_dir, 'things.gen.%d.cc' % k), 'w') as things_cc:
+            print_things_prologue(things_cc)
+            for namespace, group in groups:
+                open_namespace(things_cc, namespace)
+                for n in split_into_shards(group, shards)[k]:
+                    print >>things_cc, typeinfo(n)
+                close_namespace(things_cc, namespace)
+        with open(os.path.join(output_dir, 'harness.gen.%d.cc' % k), 'w') as harness_cc:
+            print_harness_prologue(harness_cc)
+            for namespace, group in groups:
+                if MSVC:
+                    write_chunks(harness_cc, help_msvc_with_sfinae(group))
+                open_namespace(harness_cc, namespace)
+                write_chunks(harness_cc, function_definition(split_into_shards(group, shards)[k], name, max_paths, path_seed))
+                write_chunks(harness_cc, explicit_instantiations(name, group, benchmark))
+                close_namespace(harness_cc, namespace)
+    with open(os.path.join(output_dir, 'harness.gen.cc'), 'w') as harness_cc:
+        print_harness_prologue(harness_cc)
+        for namespace, group in groups:
+            if MSVC and shards == 1:
+                write_chunks(harness_cc, help_msvc_with_sfinae(group))
+            open_namespace(harness_cc, namespace)
+            if shards > 1:
+                write_chunks(harness_cc, sharded_function_definition(function_name, shards, benchmark))
+            else:
+                write_chunks(harness_cc, function_definition(group, function_name, max_paths, path_seed))
+            close_namespace(harness_cc, namespace)
+        if benchmark:
+            print >>harness_cc, benchmark_main_function_definition(nodes)
+        else:
+            print >>harness_cc, test_main_function_definition(nodes)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--seed', type=int, default=None, help='Seed for the random number generator')
     parser.add_argument('--benchmark', action='store_true', help='Generate a benchmark harness instead of a testing harness')
+    parser.add_argument('--num-classes', type=int, default=10, metavar='N', help='Number of classes in the hierarchy')
+    parser.add_argument('--max-bases', type=int, default=3, metavar='N', help='Number of attempts to add a random base to each class')
     parser.add_argument('--msvc', action='store_true', help='Use MSVC ABI instead of Itanium ABI')
+    parser.add_argument('--tables', action='store_true', help='Look up typeinfo in sorted tables instead of chains of ifs')
+    parser.add_argument('--no-tables', dest='tables', action='store_false', help='Look up typeinfo in chains of ifs (the default)')
+    parser.add_argument('--pch', action='store_true', help='Start each .cc file with a stable prefix header that can be precompiled')
+    parser.add_argument('--shards', type=int, default=1, metavar='N', help='Split the generated .cc files into N translation units each')
+    parser.add_argument('--max-paths', type=int, default=None, metavar='N', help='Test casts from at most N subobjects of each class, sampled using --seed')
+    parser.add_argument('--output-dir', default='.', metavar='DIR', help='Directory in which to write the generated files')
     options = parser.parse_args()
     MSVC = options.msvc
 
     random.seed(options.seed)
 
-    nodes = populate()
-    with open('things.gen.h', 'w') as things_h:
-        for n in nodes:
-            print >>things_h, class_definition(n)
-    with open('things.gen.cc', 'w') as things_cc:
-        print >>things_cc, '#include "things.gen.h"'
-        print >>things_cc, '#include "dynamicast.h"'
-        print >>things_cc, '#include <cassert>'
-        print >>things_cc, '#include <cstdio>'
-        print >>things_cc, '#include <typeinfo>\n'
-        for n in nodes:
-            print >>things_cc, typeinfo_definition(n)
-        print >>things_cc, dispatcher_definition(nodes)
-    with open('harness.gen.cc', 'w') as harness_cc:
-        print >>harness_cc, '#include "things.gen.h"'
-        print >>harness_cc, '#include "dynamicast.h"'
-        if options.benchmark:
-            print >>harness_cc, '#include "benchmark-harness.h"\n'
-            if MSVC:
-                print >>harness_cc, help_msvc_with_sfinae(nodes)
-            print >>harness_cc, benchmark_to_function_definition(nodes)
-            print >>harness_cc, benchmark_main_function_definition(nodes)
-        else:
-            print >>harness_cc, '#include "test-harness.h"\n'
-            if MSVC:
-                print >>harness_cc, help_msvc_with_sfinae(nodes)
-            print >>harness_cc, test_to_function_definition(nodes)
-            print >>harness_cc, test_main_function_definition(nodes)
+    nodes = populate(num_classes=options.num_classes, max_bases=options.max_bases)
+    write_harness(
+        nodes, options.output_dir, benchmark=options.benchmark, pch=options.pch, tables=options.tables,
+        shards=options.shards, max_paths=options.max_paths, path_seed=options.seed,
+    )
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import argparse
+import imp
+import multiprocessing.pool
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GENERATE_HARNESS = os.path.join(HERE, 'generate-harness.py')
+UNITY_DUMP = os.path.join(HERE, '..', 'dependency-graph', 'unity-dump.py')
+
+generator = imp.load_source('generate_harness', GENERATE_HARNESS)
+
+
+# A hierarchy is a tuple of (name, bases), where bases is a tuple of
+# (base_name, is_virtual, is_public). Unlike Nodes, hierarchies are
+# immutable and hashable, so candidates are cheap to build and remember.
+
+def hierarchy_of(nodes):
+    return tuple(
+        (n.name, tuple((b.base.name, b.is_virtual, b.is_public) for b in n.direct_bases))
+        for n in nodes
+    )
+
+
+def nodes_of(hierarchy):
+    nodes = []
+    by_name = {}
+    for name, bases in hierarchy:
+        node = generator.Node(name)
+        for base_name, is_virtual, is_public in bases:
+            node.direct_bases += [generator.Edge(by_name[base_name], is_virtual, is_public)]
+        by_name[name] = node
+        nodes += [node]
+    return nodes
+
+
+def without_classes(hierarchy, names):
+    return tuple(
+        (name, tuple(b for b in bases if b[0] not in names))
+        for name, bases in hierarchy if name not in names
+    )
+
+
+def without_bases(hierarchy, edges):
+    return tuple(
+        (name, tuple(b for b in bases if (name, b[0]) not in edges))
+        for name, bases in hierarchy
+    )
+
+
+def with_flags_cleared(hierarchy, flips):
+    # Each flip is (class, base, 'virtual') or (class, base, 'protected'),
+    # and makes that base non-virtual or public respectively.
+    return tuple(
+        (name, tuple(
+            (b[0], b[1] and (name, b[0], 'virtual') not in flips, b[2] or (name, b[0], 'protected') in flips)
+            for b in bases
+        ))
+        for name, bases in hierarchy
+    )
+
+
+def list_classes(hierarchy):
+    return [name for name, _ in hierarchy]
+
+
+def list_bases(hierarchy):
+    return [(name, b[0]) for name, bases in hierarchy for b in bases]
+
+
+def list_flags(hierarchy):
+    result = []
+    for name, bases in hierarchy:
+        for base_name, is_virtual, is_public in bases:
+            if is_virtual:
+                result += [(name, base_name, 'virtual')]
+            if not is_public:
+                result += [(name, base_name, 'protected')]
+    return result
+
+
+def failure_kind(status, output):
+    # Candidates must fail the same way as the original seed; otherwise a
+    # wrong-offset repro could "reduce" into an unrelated compiler error.
+    if status == 0:
+        return None
+    if 'FAIL:' in output:
+        return 'mismatch'
+    if 'static assert' in output or 'static_assert' in output:
+        return 'sizeof'
+    return 'other'
+
+
+class Checker(object):
+    def __init__(self, options):
+        self.options = options
+        self.env = os.environ.copy()
+        if options.compiler != 'msvc':
+            self.env['CXXFLAGS'] = '-DFREE_USE_OF_CXX17'
+        self.results = {}
+        self.expected_kind = None
+
+    def run(self, hierarchy):
+        workdir = tempfile.mkdtemp(prefix='reduce-hierarchy-')
+        try:
+            generator.write_harness(nodes_of(hierarchy), workdir)
+            # As in find-bugs.py, the candidate's own things.gen.h must win
+            # over any stale one in HERE or in the current directory.
+            args = [
+                UNITY_DUMP, '-I', workdir, '-I', HERE,
+                os.path.join(workdir, 'things.gen.cc'),
+                os.path.join(HERE, 'dynamicast.cc'),
+                os.path.join(workdir, 'harness.gen.cc'),
+                {'gcc': '--g++', 'clang': '--clang', 'msvc': '--msvc'}[self.options.compiler],
+            ] + (['--local'] if self.options.local else [])
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=self.env, cwd=workdir)
+            output, _ = p.communicate()
+            return failure_kind(p.returncode, output)
+        finally:
+            shutil.rmtree(workdir)
+
+    def is_interesting(self, hierarchy):
+        if hierarchy not in self.results:
+            self.results[hierarchy] = (self.run(hierarchy) == self.expected_kind)
+        return self.results[hierarchy]
+
+
+def split(items, n):
+    result = []
+    start = 0
+    for i in xrange(n):
+        end = start + (len(items) - start) // (n - i)
+        result += [items[start:end]]
+        start = end
+    return result
+
+
+def ddmin(items, is_removable, pool):
+    # Zeller's delta debugging: returns a subset of `items` whose removal
+    # keeps the hierarchy interesting, and from which no single item can be
+    # added. All candidates at one granularity are checked concurrently,
+    # and the first interesting one (in order) wins, so that the result
+    # does not depend on the number of jobs.
+    removed = []
+    n = 2
+    while items:
+        n = min(n, len(items))
+        chunks = split(items, n)
+        if n > 2:
+            chunks += [[x for x in items if x not in c] for c in chunks]
+        verdicts = pool.map(lambda c: is_removable(set(removed + c)), chunks)
+        chunk = next((c for c, verdict in zip(chunks, verdicts) if verdict), None)
+        if chunk is not None:
+            removed += chunk
+            items = [x for x in items if x not in chunk]
+            n = max(n - 1, 2)
+        elif n == len(items):
+            break
+        else:
+            n = min(n * 2, len(items))
+    return removed
+
+
+def reduce_hierarchy(hierarchy, checker, pool):
+    passes = [
+        ('classes', list_classes, without_classes),
+        ('bases', list_bases, without_bases),
+        ('flags', list_flags, with_flags_cleared),
+    ]
+    progress = True
+    while progress:
+        progress = False
+        for what, list_items, apply_removal in passes:
+            current = hierarchy
+            removed = ddmin(list_items(current), lambda items: checker.is_interesting(apply_removal(current, items)), pool)
+            if removed:
+                hierarchy = apply_removal(current, set(removed))
+                progress = True
+                print >>sys.stderr, 'Removed %d %s: %d classes and %d bases remain' % (
+                    len(removed), what, len(hierarchy), len(list_bases(hierarchy)),
+                )
+    return hierarchy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, required=True, help='The failing seed to reduce')
+    parser.add_argument('--compiler', choices=['gcc', 'clang', 'msvc'], default='gcc', help='The compiler on which the seed fails')
+    parser.add_argument('--num-classes', type=int, default=10, metavar='N', help='Number of classes, as given to find-bugs.py')
+    parser.add_argument('--max-bases', type=int, default=3, metavar='N', help='Number of base attempts, as given to find-bugs.py')
+    parser.add_argument('--local', action='store_true', help='Compile with the local clang++ or g++ instead of Wandbox')
+    parser.add_argument('-j', '--jobs', type=int, default=4, metavar='N', help='Check N candidates at once')
+    parser.add_argument('--output-dir', default='.', metavar='DIR', help='Directory in which to write the reduced harness')
+    options = parser.parse_args()
+    generator.MSVC = (options.compiler == 'msvc')
+
+    random.seed(options.seed)
+    hierarchy = hierarchy_of(generator.populate(num_classes=options.num_classes, max_bases=options.max_bases))
+
+    checker = Checker(options)
+    checker.expected_kind = checker.run(hierarchy)
+    if checker.expected_kind is None:
+        print >>sys.stderr, 'Seed %d does not fail on %s' % (options.seed, options.compiler)
+        sys.exit(1)
+
+    pool = multiprocessing.pool.ThreadPool(max(options.jobs, 1))
+    hierarchy = reduce_hierarchy(hierarchy, checker, pool)
+
+    nodes = nodes_of(hierarchy)
+    generator.write_harness(nodes, options.output_dir)
+    for n in nodes:
+        if n.direct_bases:
+            print 'struct %s : %s {};' % (n.name, ', '.join(b.to_string() for b in n.direct_bases))
+        else:
+            print 'struct %s {};' % n.name
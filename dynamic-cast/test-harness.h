@@ -1,3 +1,5 @@
+#pragma once
+
 #include <cstdio>
 #include <type_traits>
 